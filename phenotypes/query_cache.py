@@ -0,0 +1,94 @@
+
+from typing import Callable, Optional
+import pandas as pd
+import hashlib
+import os
+
+# Query results are kept as compressed Parquet files named by a hash of the dataset and the
+# normalized SQL; the least recently used files are evicted once the cache exceeds its size
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", os.path.join(".", "query_cache"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+
+
+def normalize_sql(query: str) -> str:
+    # Only surrounding whitespace and a trailing semicolon are dropped; whitespace inside the
+    # query may sit in a string literal, where it changes the result
+    return query.strip().rstrip(";").rstrip()
+
+
+def cache_path(query: str, dataset: Optional[str], cache_dir: str = QUERY_CACHE_DIR) -> str:
+    key = hashlib.sha256(f"{dataset}\n{normalize_sql(query)}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+
+def cache_files(cache_dir: str = QUERY_CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return []
+    return [
+        os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".parquet")
+    ]
+
+
+def evict(cache_dir: str = QUERY_CACHE_DIR, max_bytes: int = QUERY_CACHE_MAX_BYTES) -> None:
+    # Modification time doubles as last access time (reads touch the file)
+    files = sorted(cache_files(cache_dir), key=os.path.getmtime)
+    total = sum(os.path.getsize(f) for f in files)
+    for f in files:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(f)
+        os.remove(f)
+
+
+def cached_query(
+    query: str,
+    dataset: Optional[str],
+    run_query: Callable[[], pd.DataFrame],
+    use_cache: bool = True,
+    cache_dir: str = QUERY_CACHE_DIR,
+    max_bytes: int = QUERY_CACHE_MAX_BYTES,
+) -> pd.DataFrame:
+    if not use_cache:
+        return run_query()
+
+    path = cache_path(query, dataset, cache_dir)
+    if os.path.exists(path):
+        os.utime(path)
+        print(f"Query result read from cache: {path}")
+        return pd.read_parquet(path)
+
+    df = run_query()
+
+    # A result that cannot be cached (e.g. a column type Parquet can't hold) is still returned
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(tmp_path, compression="zstd", index=False)
+        os.replace(tmp_path, path)
+        evict(cache_dir, max_bytes)
+    except Exception as e:
+        print(f"Query result not cached: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return df
+
+
+def invalidate(
+    query: Optional[str] = None,
+    dataset: Optional[str] = None,
+    cache_dir: str = QUERY_CACHE_DIR,
+) -> int:
+    # Drop one query's cached result, or the whole cache when no query is given
+    if query is not None:
+        files = [cache_path(query, dataset, cache_dir)]
+    else:
+        files = cache_files(cache_dir)
+
+    removed = 0
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+            removed += 1
+
+    return removed
@@ -1,13 +1,16 @@
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from pyarrow import feather
 from google.cloud import bigquery
 import matplotlib.pyplot as plt
 from plotnine import *
-from datetime import datetime
 import os
 
+from query_cache import cached_query
+
 client = bigquery.Client()
 
 #DATASET = os.getenv("WORKSPACE_CDR")
@@ -16,6 +19,53 @@ DATASET = "fc-aou-cdr-prod-ct.C2024Q3R5"
 BUCKET = './'
 BUCKET_DICT_PATH = os.path.join(BUCKET, 'notebooks', 'phenotype_data', 'dictionaries')
 
+# String columns carried as categoricals through the harmonize path, so merges join on
+# integer codes and flags compare codes instead of Python strings
+CATEGORICAL_COLUMNS = [
+    "src_id",
+    "standard_concept_name",
+    "standard_concept_code",
+    "standard_vocabulary",
+    "unit_concept_name",
+    "operator_concept_name",
+    "lab_name",
+    "standard_unit",
+    "assigned_unit",
+    "classified_unit",
+    "final_unit",
+]
+
+
+def categorize(df: pd.DataFrame, columns: List[str] = CATEGORICAL_COLUMNS) -> pd.DataFrame:
+    for col in columns:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+
+    return df
+
+
+def align_categories(*series: pd.Series) -> List[pd.Series]:
+    categories = pd.api.types.union_categoricals(
+        [s.astype("category") for s in series], ignore_order=True
+    ).categories
+
+    return [s.astype("category").cat.set_categories(categories) for s in series]
+
+
+def map_categories(s: pd.Series, mapping: Dict, fill: str) -> pd.Series:
+    # Map once per category instead of once per row; unmapped values keep their own name
+    s = s.astype("category")
+    mapped = pd.Series(
+        [mapping.get(c, c) for c in s.cat.categories], dtype=object
+    ).fillna(fill)
+    categories = pd.Index(pd.unique(np.append(mapped.to_numpy(), fill)))
+
+    # Code -1 (missing) picks the appended fill code
+    lookup = np.append(categories.get_indexer(mapped), categories.get_loc(fill))
+    codes = lookup[s.cat.codes.to_numpy()]
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=s.index)
+
 def preprocess(
     df: pd.DataFrame,
     columns: List[str] = [
@@ -34,7 +84,7 @@ def preprocess(
     df_columns = df.columns.tolist()
 
     if set(columns).issubset(df_columns):
-        preprocessed = df[columns]
+        preprocessed = categorize(pd.DataFrame({col: df[col] for col in columns}))
     else:
         raise ValueError(
             "Invalid combination of DataFrame columns and requested columns."
@@ -44,8 +94,9 @@ def preprocess(
 
 
 def filter_and_merge(df: pd.DataFrame, metadata: pd.DataFrame) -> pd.DataFrame:
+    metadata = categorize(metadata.copy())
     concepts = tuple(metadata["measurement_concept_id"].to_list())
-    filter_concepts = df[df["measurement_concept_id"].isin(concepts)]
+    filter_concepts = categorize(df[df["measurement_concept_id"].isin(concepts)])
 
     merged = filter_concepts.merge(
         metadata.drop("standard_concept_name", axis=1), on="measurement_concept_id"
@@ -54,15 +105,13 @@ def filter_and_merge(df: pd.DataFrame, metadata: pd.DataFrame) -> pd.DataFrame:
     return merged
 
 
-def unit_mapper(df: pd.DataFrame, unit_map: pd.DataFrame) -> pd.DataFrame:
-    df.loc[:, "assigned_unit"] = df.loc[:, "unit_concept_name"]
-
-    unit_mapping = dict(zip(unit_map["assigned_unit"], unit_map["reduced_unit"]))
-    df.loc[df["unit_concept_name"].isin(unit_mapping.keys()), "assigned_unit"] = df.loc[
-        df["unit_concept_name"].isin(unit_mapping.keys()), "unit_concept_name"
-    ].map(unit_mapping)
-
-    df.loc[(df["assigned_unit"].isnull()), "assigned_unit"] = "none"
+def unit_mapper(
+    df: pd.DataFrame, unit_map: pd.DataFrame, unit_mapping: Optional[Dict[str, str]] = None
+) -> pd.DataFrame:
+    # unit_mapping: prebuilt assigned_unit -> reduced_unit dict (read_tables()["unit_mapping"])
+    if unit_mapping is None:
+        unit_mapping = dict(zip(unit_map["assigned_unit"], unit_map["reduced_unit"]))
+    df["assigned_unit"] = map_categories(df["unit_concept_name"], unit_mapping, "none")
 
     return df
 
@@ -75,6 +124,11 @@ def unit_classifier(df: pd.DataFrame) -> pd.DataFrame:
 
 def unit_converter(df: pd.DataFrame, unit_convert: pd.DataFrame) -> pd.DataFrame:
     unit_convert = unit_convert.rename(columns={"assigned_unit": "classified_unit"})
+
+    # Same categories on both sides, so the merge joins on the integer codes
+    for col in ["lab_name", "classified_unit", "standard_unit"]:
+        df[col], unit_convert[col] = align_categories(df[col], unit_convert[col])
+
     df_c = pd.merge(
         df,
         unit_convert,
@@ -84,14 +138,13 @@ def unit_converter(df: pd.DataFrame, unit_convert: pd.DataFrame) -> pd.DataFrame
 
     df_c.loc[:, "unedited_value_as_number"] = df_c.loc[:, "value_as_number"]
 
-    df_c.loc[:, "final_unit"] = np.where(
-        (df_c.loc[:, "conversion_factor"] != 0),
-        df_c.loc[:, "standard_unit"],
-        df_c.loc[:, "classified_unit"],
-    )
-
     convert_mask = df_c.loc[:, "conversion_factor"] != 0
 
+    standard_unit, classified_unit = align_categories(
+        df_c["standard_unit"], df_c["classified_unit"]
+    )
+    df_c["final_unit"] = standard_unit.where(convert_mask, classified_unit)
+
     df_c.loc[convert_mask, "value_as_number"] = (
         df_c.loc[convert_mask, "value_as_number"]
         * df_c.loc[convert_mask, "conversion_factor"]
@@ -111,9 +164,8 @@ def measurement_flagger(
     df.loc[:, "unit_none_flag"] = df.loc[:, "assigned_unit"] == "none"
     units_renamed = unit_map["assigned_unit"].to_list()
     df.loc[:, "unit_rename_flag"] = df.loc[:, "unit_concept_name"].isin(units_renamed)
-    df.loc[:, "unit_discord_flag"] = (
-        df.loc[:, "final_unit"] != df.loc[:, "standard_unit"]
-    )
+    final_unit, standard_unit = align_categories(df["final_unit"], df["standard_unit"])
+    df.loc[:, "unit_discord_flag"] = final_unit != standard_unit
     df.loc[:, "outlier_flag"] = np.where(
         (df.loc[:, "value_as_number"] < df.loc[:, "minimum_value"])
         | (df.loc[:, "value_as_number"] > df.loc[:, "maximum_value"]),
@@ -124,19 +176,80 @@ def measurement_flagger(
     return df
 
 
+def lookup_rows(
+    df: pd.DataFrame, table: pd.DataFrame, keys: List[str]
+) -> np.ndarray:
+    # Row of table matching each row of df on keys (-1 if none), computed on category codes;
+    # missing keys match missing keys, as in a merge
+    if table.duplicated(keys).any():
+        raise ValueError(f"Reference table has duplicate rows for {keys}.")
+
+    df_key = np.zeros(len(df), dtype=np.int64)
+    table_key = np.zeros(len(table), dtype=np.int64)
+    for col in keys:
+        df_col, table_col = align_categories(df[col], table[col])
+        n = len(df_col.cat.categories) + 1
+        df_key = df_key * n + df_col.cat.codes.to_numpy() + 1
+        table_key = table_key * n + table_col.cat.codes.to_numpy() + 1
+
+    return pd.Index(table_key).get_indexer(df_key)
+
+
+def take_rows(table: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+    # Rows of table by position, all-missing where rows is -1
+    return table.reset_index(drop=True).reindex(rows).reset_index(drop=True)
+
+
 def harmonize(
     df: pd.DataFrame,
     metadata: pd.DataFrame,
     unit_map: pd.DataFrame,
     unit_convert: pd.DataFrame,
     nan_equivalents: List[int] = [10000000, 100000000],
+    unit_mapping: Optional[Dict[str, str]] = None,
 ) -> pd.DataFrame:
-    filtered = filter_and_merge(df, metadata)
-    mapped = unit_mapper(filtered, unit_map)
-    classified = unit_classifier(mapped)
-    converted = unit_converter(classified, unit_convert)
-    flagged = measurement_flagger(converted, unit_map, nan_equivalents)
-    flagged = flagged.merge(metadata[["lab_name", "measurement_concept_id"]])
+    # Single pass equivalent of filter_and_merge -> unit_mapper -> unit_classifier ->
+    # unit_converter -> measurement_flagger: metadata and conversion factors are looked up
+    # by row position instead of merged, so only one output frame is built
+    metadata = categorize(metadata.copy())
+    keep = df["measurement_concept_id"].isin(metadata["measurement_concept_id"]).to_numpy()
+    harmonized = categorize(df[keep].reset_index(drop=True))
+
+    meta_rows = lookup_rows(harmonized, metadata, ["measurement_concept_id"])
+    meta_cols = metadata.drop(["measurement_concept_id", "standard_concept_name"], axis=1)
+    for col, values in take_rows(meta_cols, meta_rows).items():
+        harmonized[col] = values
+
+    if unit_mapping is None:
+        unit_mapping = dict(zip(unit_map["assigned_unit"], unit_map["reduced_unit"]))
+    harmonized["assigned_unit"] = map_categories(harmonized["unit_concept_name"], unit_mapping, "none")
+    harmonized["classified_unit"] = harmonized["assigned_unit"]
+
+    keys = ["lab_name", "classified_unit", "standard_unit"]
+    unit_convert = categorize(unit_convert.rename(columns={"assigned_unit": "classified_unit"}))
+    convert_rows = lookup_rows(harmonized, unit_convert, keys)
+    for col, values in take_rows(unit_convert.drop(keys, axis=1), convert_rows).items():
+        harmonized[col] = values
+
+    # Missing conversion factors also count as != 0, as in unit_converter
+    convert_mask = (harmonized["conversion_factor"] != 0).to_numpy()
+    value = harmonized["value_as_number"].to_numpy()
+    harmonized["unedited_value_as_number"] = value
+    harmonized["value_as_number"] = np.where(
+        convert_mask, value * harmonized["conversion_factor"].to_numpy(), value
+    )
+
+    standard_unit, classified_unit = align_categories(
+        harmonized["standard_unit"], harmonized["classified_unit"]
+    )
+    harmonized["final_unit"] = standard_unit.where(convert_mask, classified_unit)
+
+    flagged = measurement_flagger(harmonized, unit_map, nan_equivalents)
+
+    # Categories of filtered-out labs and units would otherwise show up in groupbys and plots
+    for col in CATEGORICAL_COLUMNS:
+        if col in flagged.columns:
+            flagged[col] = flagged[col].cat.remove_unused_categories()
 
     return flagged
 
@@ -165,43 +278,97 @@ def trim(df: pd.DataFrame) -> pd.DataFrame:
     return final
 
 
-def read_tables(
-    pipeline_version: str = "v1_0", dict_path: str = BUCKET_DICT_PATH
-) -> Dict[str, pd.DataFrame]:
-    metadata_table = f"metadata_{pipeline_version}.feather"
-    unit_map_table = f"unit_map_{pipeline_version}.feather"
-    unit_reduce_table = f"unit_reduce_{pipeline_version}.feather"
-    site_drop_table = f"site_drop_{pipeline_version}.feather"
+# Reference tables already read in this process, keyed on directory, pipeline version and
+# file modification times, so an edited table is read again. Each entry holds the
+# memory-mapped Arrow tables, the pandas frames converted from them once and the lookups
+# derived from those frames. The frames read straight from the mapped files, so update a
+# table by writing a new file and renaming it over the old one, never by rewriting it in place
+TABLE_CACHE: Dict[tuple, Dict] = {}
+
+
+def read_feather_mapped(path: str) -> pa.Table:
+    # Columns of an uncompressed file stay in the OS page cache, shared by every process
+    # that maps the same file
+    return feather.read_table(path, memory_map=True)
 
-    metadata = pd.read_feather(
-        os.path.join(BUCKET_DICT_PATH, pipeline_version, metadata_table)
-    )
-    unit_map = pd.read_feather(
-        os.path.join(BUCKET_DICT_PATH, pipeline_version, unit_map_table)
-    )
-    unit_reduce = pd.read_feather(
-        os.path.join(BUCKET_DICT_PATH, pipeline_version, unit_reduce_table)
-    )
-    site_drop = pd.read_feather(
-        os.path.join(BUCKET_DICT_PATH, pipeline_version, site_drop_table)
-    )
 
+def arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    # One block per column: numeric columns without nulls become read-only views on the
+    # Arrow buffers instead of copies; string columns are still built as Python objects
+    return table.to_pandas(split_blocks=True)
+
+
+def table_lookups(tables: Dict[str, pd.DataFrame]) -> Dict:
+    unit_map = tables["unit_map"]
+    unit_reduce = tables["unit_reduce"]
     return {
-        "metadata": metadata,
-        "unit_map": unit_map,
-        "unit_reduce": unit_reduce,
-        "site_drop": site_drop,
+        "unit_mapping": dict(zip(unit_map["assigned_unit"], unit_map["reduced_unit"])),
+        "conversion_factors": unit_reduce.set_index(
+            ["lab_name", "assigned_unit", "standard_unit"]
+        )["conversion_factor"],
+    }
+
+
+def read_tables(
+    pipeline_version: str = "v1_0",
+    dict_path: str = BUCKET_DICT_PATH,
+    use_cache: bool = True,
+    copy: bool = False,
+) -> Dict:
+    names = ["metadata", "unit_map", "unit_reduce", "site_drop"]
+    paths = {
+        name: os.path.abspath(
+            os.path.join(dict_path, pipeline_version, f"{name}_{pipeline_version}.feather")
+        )
+        for name in names
     }
+    key = (
+        os.path.abspath(dict_path),
+        pipeline_version,
+        tuple(os.stat(paths[name]).st_mtime_ns for name in names),
+    )
 
+    if not use_cache or key not in TABLE_CACHE:
+        # Older versions of the same tables are not handed out again
+        for old in [k for k in TABLE_CACHE if k[:2] == key[:2]]:
+            del TABLE_CACHE[old]
+        arrow = {name: read_feather_mapped(paths[name]) for name in names}
+        frames = {name: arrow_to_pandas(table) for name, table in arrow.items()}
+        TABLE_CACHE[key] = {"arrow": arrow, "frames": frames, "lookups": table_lookups(frames)}
 
-def client_read_gbq(query: str, dataset: str = DATASET) -> pd.DataFrame:
+    # Shallow copies share the cached data with every other caller: adding or replacing
+    # columns stays local, but in-place edits (.loc) need copy=True
+    tables = {**TABLE_CACHE[key]["frames"], **TABLE_CACHE[key]["lookups"]}
+    if copy:
+        return {name: dict(t) if isinstance(t, dict) else t.copy(deep=True) for name, t in tables.items()}
+    return {name: dict(t) if isinstance(t, dict) else t.copy(deep=False) for name, t in tables.items()}
+
+
+def clear_table_cache() -> None:
+    TABLE_CACHE.clear()
+
+
+def client_read_gbq(query: str, dataset: str = DATASET, use_cache: bool = True) -> pd.DataFrame:
+    def run_query() -> pd.DataFrame:
+        job_config = bigquery.QueryJobConfig(default_dataset=dataset)
+        query_job = client.query(query, job_config=job_config)
+        return query_job.result().to_dataframe()
+
+    df = cached_query(query, dataset, run_query, use_cache)
+    return df
+
+
+def client_read_gbq_batches(
+    query: str, dataset: str = DATASET, page_size: int = 1000000
+) -> Iterator[pd.DataFrame]:
     job_config = bigquery.QueryJobConfig(default_dataset=dataset)
     query_job = client.query(query, job_config=job_config)
-    df = query_job.result().to_dataframe()
-    return df
+    # One DataFrame per result page, so the full result never has to fit in memory
+    for df in query_job.result(page_size=page_size).to_dataframe_iterable():
+        yield df
 
 
-def measurement_data(m_cid: List[int]) -> pd.DataFrame:
+def measurement_query(m_cid: List[int]) -> str:
     m_cid_str = ", ".join(map(str, m_cid))
     query = f"""
             SELECT DISTINCT person_id
@@ -231,10 +398,20 @@ def measurement_data(m_cid: List[int]) -> pd.DataFrame:
                       
             WHERE measurement_concept_id IN ({m_cid_str})
             """
-    df = client_read_gbq(query)
+    return query
+
+
+def measurement_data(m_cid: List[int], use_cache: bool = True) -> pd.DataFrame:
+    df = client_read_gbq(measurement_query(m_cid), use_cache=use_cache)
     return df
 
 
+def measurement_data_batches(
+    m_cid: List[int], page_size: int = 1000000
+) -> Iterator[pd.DataFrame]:
+    return client_read_gbq_batches(measurement_query(m_cid), page_size=page_size)
+
+
 def query_summary(df: pd.DataFrame) -> pd.DataFrame:
     grouped = df.groupby(["standard_concept_name", "measurement_concept_id"])
 
@@ -307,10 +484,46 @@ def get_shape(row_dim: int):
     return shape_
 
 
+# Percentile columns reported by units_dist (the median has its own column)
+UNIT_PERCENTILES = {
+    "percentile_01": 0.01,
+    "percentile_10": 0.1,
+    "percentile_75": 0.75,
+    "percentile_99": 0.99,
+}
+
+
+def grouped_quantiles(
+    groups: pd.Series, values: pd.Series, qs: Dict[str, float] = UNIT_PERCENTILES
+) -> pd.DataFrame:
+    # All quantiles of every group from one sort of (group, value), with the linear
+    # interpolation of Series.quantile
+    codes, uniques = pd.factorize(groups)
+    v = values.to_numpy(dtype=float)
+    order = np.lexsort((v, codes))
+    v = v[order]
+    codes = codes[order]
+
+    starts = np.searchsorted(codes, np.arange(len(uniques)))
+    count = np.diff(np.r_[starts, len(v)])
+
+    result = pd.DataFrame({groups.name: uniques})
+    for name, q in qs.items():
+        h = q * (count - 1)
+        lo = np.floor(h).astype(np.int64)
+        t = h - lo
+        a = v[starts + lo]
+        b = v[starts + np.minimum(lo + 1, count - 1)]
+        # Same two-sided lerp as numpy, so results match it bit for bit
+        result[name] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+
+    return result
+
+
 def units_dist(df: pd.DataFrame) -> pd.DataFrame:
     pid_src = (
         df[["assigned_unit", "person_id", "src_id", "value_as_number"]]
-        .groupby(["assigned_unit"])
+        .groupby(["assigned_unit"], observed=True)
         .agg(
             {
                 "person_id": "nunique",
@@ -338,7 +551,7 @@ def units_dist(df: pd.DataFrame) -> pd.DataFrame:
                 "conversion_factor",
             ]
         ]
-        .groupby(["assigned_unit"])
+        .groupby(["assigned_unit"], observed=True)
         .agg(
             {
                 "missing_value_flag": "sum",
@@ -365,7 +578,7 @@ def units_dist(df: pd.DataFrame) -> pd.DataFrame:
     base_cols = ["assigned_unit", "value_as_number"]
     df_units = masked[base_cols]
     df_stats = (
-        df_units.groupby([c for c in base_cols if c != "value_as_number"])
+        df_units.groupby([c for c in base_cols if c != "value_as_number"], observed=True)
         .agg(
             {
                 "value_as_number": [
@@ -375,23 +588,91 @@ def units_dist(df: pd.DataFrame) -> pd.DataFrame:
                     "max",
                     "mean",
                     "std",
-                    percentile(0.01),
-                    percentile(0.1),
-                    percentile(0.75),
-                    percentile(0.99),
                 ]
             }
         )
         .rename(columns={"count": "filtered_count"})
     )
     df_stats.columns = [c[1] for c in df_stats.columns]
+    df_stats = df_stats.reset_index().merge(
+        grouped_quantiles(df_units["assigned_unit"], df_units["value_as_number"]),
+        how="left",
+        on="assigned_unit",
+    )
 
     unit_stats = pid_src.merge(meas_dropped, how="left", on="assigned_unit")
     unit_stats = unit_stats.merge(df_stats, how="left", on="assigned_unit")
 
+    # Units in alphabetical order (category order follows the unit map)
+    unit_stats = unit_stats.sort_values(
+        "assigned_unit", key=lambda s: s.astype(str)
+    ).reset_index(drop=True)
+
     return unit_stats
 
 
+def box_summaries(
+    df: pd.DataFrame,
+    group_cols: List[str],
+    value_col: str,
+    log_scale: bool = False,
+    coef: float = 1.5,
+    max_outliers: int = 1000,
+) -> pd.DataFrame:
+    # Per-group boxplot statistics as geom_boxplot's stat computes them (quartiles, whiskers at
+    # the furthest data within coef * IQR, points beyond), from one sort of (group, value).
+    # On a log scale the statistics are taken on log10 values, as plotnine does after the
+    # scale transform; outliers stay log10 because geom_boxplot draws them untransformed.
+    v = df[value_col].to_numpy(dtype=float)
+    keep = np.isfinite(v) & (v > 0) if log_scale else ~np.isnan(v)
+    data = df.loc[keep, group_cols].reset_index(drop=True)
+    v = np.log10(v[keep]) if log_scale else v[keep]
+
+    codes = data.groupby(group_cols, observed=True, sort=True).ngroup().to_numpy()
+    order = np.lexsort((v, codes))
+    v = v[order]
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[len(v) > 0, codes[1:] != codes[:-1]])
+    n_groups = len(starts)
+
+    summary = data.iloc[order[starts]].reset_index(drop=True)
+    quartiles = grouped_quantiles(
+        pd.Series(codes, name="group"), pd.Series(v), {"lower": 0.25, "middle": 0.5, "upper": 0.75}
+    )
+    q1 = quartiles["lower"].to_numpy()
+    q3 = quartiles["upper"].to_numpy()
+    iqr = q3 - q1
+
+    inside = v >= (q1 - coef * iqr)[codes]
+    lowest = pd.Series(v[inside]).groupby(codes[inside]).min().reindex(range(n_groups)).to_numpy()
+    whislo = np.where(np.isnan(lowest) | (lowest > q1), q1, lowest)
+    inside = v <= (q3 + coef * iqr)[codes]
+    highest = pd.Series(v[inside]).groupby(codes[inside]).max().reindex(range(n_groups)).to_numpy()
+    whishi = np.where(np.isnan(highest) | (highest < q3), q3, highest)
+
+    # Outliers thinned to at most max_outliers evenly spaced (sorted) values per group,
+    # always keeping the most extreme ones
+    is_outlier = (v < whislo[codes]) | (v > whishi[codes])
+    out_v = v[is_outlier]
+    out_codes = codes[is_outlier]
+    m = np.bincount(out_codes, minlength=n_groups)
+    rank = np.arange(len(out_v)) - np.r_[0, np.cumsum(m)[:-1]][out_codes]
+    step = np.maximum(m[out_codes] - 1, 1) / max(max_outliers - 1, 1)
+    thinned = (m[out_codes] <= max_outliers) | (rank == 0) | (
+        np.floor(rank / step) != np.floor((rank - 1) / step)
+    )
+    out_v = out_v[thinned]
+    out_codes = out_codes[thinned]
+    bounds = np.cumsum(np.bincount(out_codes, minlength=n_groups))[:-1]
+    summary["outliers"] = [list(o) for o in np.split(out_v, bounds)]
+
+    stats = {"ymin": whislo, "lower": q1, "middle": quartiles["middle"].to_numpy(), "upper": q3, "ymax": whishi}
+    for col, values in stats.items():
+        summary[col] = 10 ** values if log_scale else values
+
+    return summary
+
+
 def boxplot(
     df: pd.DataFrame,
     df_state: str,
@@ -399,6 +680,8 @@ def boxplot(
     value_col: str,
     w: int = 12,
     h: int = 12,
+    summarized: bool = True,
+    max_outliers: int = 1000,
 ) -> ggplot:
     if df_state == "annotated":
         df = df[df["missing_value_flag"] == False]
@@ -410,19 +693,40 @@ def boxplot(
     min_val = df[value_col].min()
     max_val = df[value_col].max()
     mean_val = df[value_col].mean()
+    log_scale = max_val > (10 * mean_val)
 
     df_final = df.copy(deep=True)[["src_id", fill_col, "lab_name", value_col]]
     df_final[fill_col] = df_final[fill_col].astype("str")
 
     #c_name = df_final["lab_name"].unique()[0]
+    if summarized:
+        # Boxes drawn from per-(site, unit) summaries, so drawing time does not grow with rows
+        summary = box_summaries(
+            df_final, ["src_id", fill_col], value_col, log_scale, max_outliers=max_outliers
+        )
+        p = ggplot(
+            summary,
+            aes(
+                x="src_id",
+                ymin="ymin",
+                lower="lower",
+                middle="middle",
+                upper="upper",
+                ymax="ymax",
+                outliers="outliers",
+                color=f"factor({fill_col})",
+            ),
+        ) + geom_boxplot(stat="identity", width=0.75)  # stat_boxplot's default box width
+    else:
+        p = ggplot(df_final, aes(x="src_id", y=value_col, color=f"factor({fill_col})")) + geom_boxplot()
+
     p = (
-        ggplot(df_final, aes(x="src_id", y=value_col, color=f"factor({fill_col})"))
-        + geom_boxplot()
+        p
         + labs(title=f"Comparing distributions of EHR  measures", x="EHR site")
         + theme(axis_text_x=element_text(angle=90, hjust=1), figure_size=(w, h))
     )
 
-    if max_val > (10 * mean_val):
+    if log_scale:
         plot = p + labs(y="value (log scale)") + scale_y_log10()
     else:
         plot = p + labs(y="value")
@@ -469,31 +773,389 @@ def plot_hist_single_lab_unit(
     ax.legend(loc="upper right")
 
 
+def epoch_days(s: pd.Series) -> np.ndarray:
+    # Calendar date of each datetime (in its own time zone) as int64 days since 1970-01-01
+    s = pd.to_datetime(s)
+    if s.dt.tz is not None:
+        s = s.dt.tz_localize(None)
+    return s.to_numpy(dtype="datetime64[D]").astype(np.int64)
+
+
 def pid_level_summary(m_cids, clean_lab_df, base_cols = ['person_id', 'value_as_number'], save_file = True
                      , BUCKET = BUCKET):
-    
-    df = clean_lab_df[base_cols+['measurement_datetime']].drop_duplicates()
-    df['measurement_date'] = [datetime.strptime(str(i.date()), "%Y-%m-%d").timestamp() for i in df['measurement_datetime']]
-    df = df[base_cols+['measurement_date']].drop_duplicates().reset_index(drop = True)
-
-    df_latest= df.loc[df.groupby('person_id')['measurement_date'].idxmax()]
-    df_latest = df_latest[base_cols].drop_duplicates()
-    df_latest.columns = ['person_id','latest']
-    df_latest = df_latest.reset_index(drop = True)
-    
-    df_stats = clean_lab_df[base_cols]; df_stats[df_stats.value_as_number.notna()]    
-    df_stats = df_stats.groupby([c for c in base_cols if c != 'value_as_number'])\
-                                .agg({'value_as_number':['min','median','max','mean', 'count']})
-    df_stats.columns = [c[1] for c in df_stats.columns]
-    df_stats = df_stats.reset_index()
+    value_col = base_cols[-1]
+    key_cols = [c for c in base_cols if c != value_col]
+
+    # Latest value: sort once by person and date (newest first); the stable sort keeps the
+    # first-listed value among same-day measurements, as idxmax did
+    dated = clean_lab_df[base_cols+['measurement_datetime']]
+    dated = dated[dated[value_col].notna() & dated['measurement_datetime'].notna()]
+    days = epoch_days(dated['measurement_datetime'])
+    person = dated['person_id'].to_numpy()
+    order = np.lexsort((-days, person))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = person[order][1:] != person[order][:-1]
+    df_latest = pd.DataFrame({
+        'person_id': person[order][first],
+        'latest': dated[value_col].to_numpy()[order][first],
+    })
+
+    # Statistics in one pass over values sorted within each group: min, max and median are
+    # read off group positions. The mean uses pandas' grouped mean over the rows in their
+    # original order, so it rounds (and truncates to int64) exactly as before
+    values = clean_lab_df[base_cols]
+    values = values[values[value_col].notna()]
+    codes = values.groupby(key_cols, sort=True).ngroup().to_numpy()
+    v = values[value_col].to_numpy(dtype=float)
+    mean = pd.Series(v).groupby(codes, sort=True).mean().to_numpy()
+    order = np.lexsort((v, codes))
+    v = v[order]
+    starts = np.flatnonzero(np.r_[len(v) > 0, codes[order][1:] != codes[order][:-1]])
+    count = np.diff(np.r_[starts, len(v)])
+    df_stats = values[key_cols].iloc[order[starts]].reset_index(drop=True)
+    df_stats['min'] = v[starts]
+    df_stats['median'] = (v[starts + (count - 1) // 2] + v[starts + count // 2]) / 2
+    df_stats['max'] = v[starts + count - 1]
+    df_stats['mean'] = mean
+    df_stats['count'] = count
 
     df_final = df_stats.astype('int64').merge(df_latest.astype('int64')).drop_duplicates()
     
     # Save file
-    m_cids_str = str(m_cids).replace('[','').replace(']','').replace(', ','_')
     if save_file == True:
-        filename = f'measurement_{m_cids_str}_summary.csv'
-        df_final.to_csv(filename, index=False)  
-        print(f"\n'{filename}' saved locally hopefully...") 
+        save_pid_summary(m_cids, df_final)
 
     return df_final
+
+
+def save_pid_summary(m_cids, df_final):
+    m_cids_str = str(m_cids).replace('[','').replace(']','').replace(', ','_')
+    filename = f'measurement_{m_cids_str}_summary.csv'
+    df_final.to_csv(filename, index=False)  
+    print(f"\n'{filename}' saved locally hopefully...") 
+
+
+class QuantileSketch:
+    # Mergeable per-group quantile sketch: each value is rounded to a log-spaced bucket
+    # (relative error alpha) and only (group, bucket) counts are kept. alpha=0 keeps exact
+    # (group, value) counts instead: exact quantiles, memory bound by distinct values per group.
+    # Batch counts are buffered and folded in once they outgrow the consolidated counts, so
+    # adding a batch does not re-align the whole index every time.
+    def __init__(self, alpha: float = 0.005, min_pending: int = 1000000):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.min_pending = min_pending
+        self.counts = None
+        self.pending = []
+        self.pending_size = 0
+
+    def bucket(self, values: np.ndarray) -> np.ndarray:
+        if self.alpha == 0:
+            return values
+        magnitude = np.abs(values)
+        with np.errstate(divide="ignore"):
+            k = np.ceil(np.log(magnitude) / np.log(self.gamma))
+            center = 2 * self.gamma ** k / (self.gamma + 1)
+        return np.where(magnitude > 0, np.sign(values) * center, 0.0)
+
+    def add(self, groups: pd.Series, values: pd.Series) -> None:
+        values = values.to_numpy(dtype=float)
+        keep = ~np.isnan(values)
+        counts = pd.Series(np.ones(keep.sum(), dtype=np.int64)).groupby(
+            [groups.astype(str).to_numpy()[keep], self.bucket(values[keep])]
+        ).sum()
+        self.pending.append(counts)
+        self.pending_size += len(counts)
+        if self.pending_size >= max(self.min_pending, 0 if self.counts is None else len(self.counts)):
+            self.consolidate()
+
+    def consolidate(self) -> Optional[pd.Series]:
+        if self.pending:
+            parts = self.pending if self.counts is None else [self.counts] + self.pending
+            self.counts = pd.concat(parts).groupby(level=[0, 1]).sum()
+            self.pending = []
+            self.pending_size = 0
+        return self.counts
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        if other.consolidate() is not None:
+            self.pending.append(other.counts)
+            self.pending_size += len(other.counts)
+            self.consolidate()
+        return self
+
+    def quantiles(self, qs: Dict[str, float]) -> pd.DataFrame:
+        if self.consolidate() is None or self.counts.empty:
+            return pd.DataFrame(columns=list(qs))
+
+        counts = self.counts.sort_index()
+        groups = counts.index.get_level_values(0).to_numpy()
+        buckets = counts.index.get_level_values(1).to_numpy()
+        cumulative = counts.groupby(level=0).cumsum().to_numpy()
+        totals = counts.groupby(level=0).transform("sum").to_numpy()
+
+        def value_at(rank: np.ndarray) -> pd.Series:
+            # Bucket holding the given 0-based rank of each group
+            reached = pd.Series(cumulative > rank, index=np.arange(len(counts)))
+            first = reached.groupby(groups).idxmax()
+            return pd.Series(buckets[first.to_numpy()], index=first.index)
+
+        # Interpolate between ranks floor(h) and floor(h) + 1, h = q * (n - 1), as
+        # Series.quantile does
+        result = {}
+        for name, q in qs.items():
+            h = q * (totals - 1)
+            lo = np.floor(h)
+            a = value_at(lo)
+            b = value_at(np.minimum(lo + 1, totals - 1))
+            t = pd.Series(h - lo, index=groups).groupby(level=0).first().reindex(a.index)
+            result[name] = a.where(t == 0, np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t))
+
+        return pd.DataFrame(result)
+
+
+class UnitsDistAccumulator:
+    # Streaming units_dist: counts and moments are combined per batch, n_pids / n_ehr come
+    # from de-duplicated (unit, id) pairs and the median and percentiles from a QuantileSketch
+    quantile_columns = {"median": 0.5, **UNIT_PERCENTILES}
+    columns = [
+        "assigned_unit", "n_pids", "n_ehr", "total_meas", "missing", "meas_avail", "outliers",
+        "conversion_factor", "filtered_count", "min", "median", "max", "mean", "std",
+    ] + list(UNIT_PERCENTILES)
+
+    def __init__(self, alpha: float = 0.005):
+        self.pairs = {"person_id": None, "src_id": None}
+        self.counts = None
+        self.factors = None
+        self.moments = None
+        self.sketch = QuantileSketch(alpha)
+
+    def add(self, df: pd.DataFrame) -> None:
+        unit = df["assigned_unit"].astype(str)
+
+        for col in self.pairs:
+            pairs = pd.DataFrame({"assigned_unit": unit, col: df[col].astype(str)}).drop_duplicates()
+            if self.pairs[col] is not None:
+                pairs = pd.concat([self.pairs[col], pairs]).drop_duplicates()
+            self.pairs[col] = pairs
+
+        counts = pd.DataFrame(
+            {
+                "total_meas": unit.groupby(unit).size(),
+                "missing": df["missing_value_flag"].groupby(unit).sum(),
+                "meas_avail": df["value_as_number"].groupby(unit).count(),
+                "outliers": df["outlier_flag"].groupby(unit).sum(),
+            }
+        )
+        self.counts = counts if self.counts is None else self.counts.add(counts, fill_value=0)
+
+        # First conversion factor seen per unit (units_dist takes the first unique value)
+        factors = pd.DataFrame({"assigned_unit": unit, "conversion_factor": df["conversion_factor"]})
+        if self.factors is not None:
+            factors = pd.concat([self.factors, factors])
+        self.factors = factors.drop_duplicates("assigned_unit")
+
+        mask = (df["missing_value_flag"] == False) & (df["outlier_flag"] == False)
+        values = df.loc[mask, "value_as_number"]
+        units = unit[mask]
+        grouped = values.groupby(units)
+        moments = pd.DataFrame(
+            {
+                "n": grouped.count(),
+                "mean": grouped.mean(),
+                "m2": grouped.var(ddof=0) * grouped.count(),
+                "min": grouped.min(),
+                "max": grouped.max(),
+            }
+        )
+        moments = moments[moments["n"] > 0]
+        self.moments = moments if self.moments is None else self.merge_moments(self.moments, moments)
+        self.sketch.add(units, values)
+
+    @staticmethod
+    def merge_moments(a: pd.DataFrame, b: pd.DataFrame) -> pd.DataFrame:
+        # Chan et al. pairwise update of count, mean and sum of squared deviations
+        index = a.index.union(b.index)
+        a = a.reindex(index)
+        b = b.reindex(index)
+        n_a = a["n"].fillna(0)
+        n_b = b["n"].fillna(0)
+        n = n_a + n_b
+        delta = b["mean"].fillna(0) - a["mean"].fillna(0)
+        return pd.DataFrame(
+            {
+                "n": n,
+                "mean": np.where(n_a == 0, b["mean"], np.where(n_b == 0, a["mean"], a["mean"] + delta * n_b / n)),
+                "m2": a["m2"].fillna(0) + b["m2"].fillna(0) + delta ** 2 * n_a * n_b / n,
+                "min": np.fmin(a["min"], b["min"]),
+                "max": np.fmax(a["max"], b["max"]),
+            },
+            index=index,
+        )
+
+    def result(self) -> pd.DataFrame:
+        if self.counts is None:
+            return pd.DataFrame(columns=self.columns)
+
+        unit_stats = pd.DataFrame(
+            {
+                "n_pids": self.pairs["person_id"].groupby("assigned_unit").size(),
+                "n_ehr": self.pairs["src_id"].groupby("assigned_unit").size(),
+            }
+        )
+        unit_stats = unit_stats.join(self.counts.astype("int64"))
+        unit_stats = unit_stats.join(self.factors.set_index("assigned_unit"))
+
+        stats = self.moments.rename(columns={"n": "filtered_count"})
+        stats["std"] = np.sqrt(stats["m2"] / (stats["filtered_count"] - 1))
+        stats = stats.join(self.sketch.quantiles(self.quantile_columns))
+        stats = stats[
+            ["filtered_count", "min", "median", "max", "mean", "std"]
+            + [c for c in self.quantile_columns if c != "median"]
+        ]
+
+        unit_stats = unit_stats.join(stats)
+        unit_stats.index.name = "assigned_unit"
+        return unit_stats.sort_index().reset_index()
+
+
+class PidSummaryAccumulator:
+    # Streaming pid_level_summary: per-person running min / max / count / sum and latest
+    # (date, value), so memory grows with participants rather than measurements. The median
+    # comes from a log-bucket sketch (within alpha, before the int64 cast); alpha=0 gives the
+    # exact median, at the cost of one (person, value) count per distinct value.
+    columns = ["person_id", "min", "median", "max", "mean", "count", "latest"]
+
+    def __init__(self, alpha: float = 0.005):
+        self.stats = None
+        self.latest = None
+        self.sketch = QuantileSketch(alpha)
+
+    def add(self, clean_lab_df: pd.DataFrame) -> None:
+        df = clean_lab_df[["person_id", "value_as_number", "measurement_datetime"]]
+        df = df[df["value_as_number"].notna()]
+        person = df["person_id"]
+        values = df["value_as_number"]
+
+        grouped = values.groupby(person)
+        stats = pd.DataFrame(
+            {"min": grouped.min(), "max": grouped.max(), "count": grouped.count(), "sum": grouped.sum()}
+        )
+        if self.stats is not None:
+            stats = pd.concat([self.stats, stats]).groupby(level=0).agg(
+                {"min": "min", "max": "max", "count": "sum", "sum": "sum"}
+            )
+        self.stats = stats
+        self.sketch.add(person, values)
+
+        # Newest date per person in this batch (first-listed value among same-day ones), then
+        # kept over the running latest only if strictly newer, as a single pass would
+        dated = df[df["measurement_datetime"].notna()]
+        days = epoch_days(dated["measurement_datetime"])
+        order = np.lexsort((-days, dated["person_id"].to_numpy()))
+        latest = pd.DataFrame(
+            {
+                "person_id": dated["person_id"].to_numpy()[order],
+                "date": days[order],
+                "latest": dated["value_as_number"].to_numpy()[order],
+            }
+        ).drop_duplicates("person_id")
+        if self.latest is not None:
+            latest = pd.concat([self.latest, latest]).sort_values(
+                ["person_id", "date"], ascending=[True, False], kind="mergesort"
+            ).drop_duplicates("person_id")
+        self.latest = latest
+
+    def result(self, m_cids: List[int], save_file: bool = True) -> pd.DataFrame:
+        if self.stats is None or self.stats.empty:
+            df_final = pd.DataFrame(columns=self.columns)
+        else:
+            medians = self.sketch.quantiles({"median": 0.5})
+            medians.index = medians.index.astype(self.stats.index.dtype)
+            stats = self.stats.join(medians)
+            stats["mean"] = stats["sum"] / stats["count"]
+            stats.index.name = "person_id"
+            stats = stats.reset_index()[self.columns[:-1]].astype("int64")
+            df_final = stats.merge(self.latest[["person_id", "latest"]].astype("int64"))
+
+        if save_file == True:
+            save_pid_summary(m_cids, df_final)
+
+        return df_final
+
+
+def harmonize_stream(
+    m_cid: List[int],
+    metadata: pd.DataFrame,
+    unit_map: pd.DataFrame,
+    unit_convert: pd.DataFrame,
+    output_file: Optional[str] = None,
+    page_size: int = 1000000,
+    save_file: bool = True,
+    nan_equivalents: List[int] = [10000000, 100000000],
+    batches: Optional[Iterator[pd.DataFrame]] = None,
+) -> Dict[str, pd.DataFrame]:
+    # Harmonize the query result page by page; trimmed rows are appended to output_file and
+    # only the units_dist and pid_level_summary aggregates are kept in memory
+    if batches is None:
+        batches = measurement_data_batches(m_cid, page_size)
+
+    units = UnitsDistAccumulator()
+    pids = PidSummaryAccumulator()
+    rows = 0
+    for i, batch in enumerate(batches):
+        harmonized = harmonize(preprocess(batch), metadata, unit_map, unit_convert, nan_equivalents)
+        units.add(harmonized)
+
+        final = trim(harmonized)
+        pids.add(final)
+        if output_file is not None:
+            final.to_csv(output_file, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        rows += len(batch)
+
+    print(f"Harmonized {rows} measurements.")
+
+    return {
+        "unit_stats": units.result(),
+        "pid_summary": pids.result(m_cid, save_file),
+    }
+
+
+def harmonize_labs(
+    metadata: pd.DataFrame,
+    unit_map: pd.DataFrame,
+    unit_convert: pd.DataFrame,
+    m_cids: Optional[List[int]] = None,
+    output_dir: str = ".",
+    save_file: bool = True,
+    nan_equivalents: List[int] = [10000000, 100000000],
+    measurement: Optional[pd.DataFrame] = None,
+) -> Dict[str, Dict[str, pd.DataFrame]]:
+    # Whole lab panel in one query and one harmonize pass (all labs in metadata by default),
+    # then split by lab_name into the per-lab trimmed data and participant summaries
+    if m_cids is not None:
+        metadata = metadata[metadata["measurement_concept_id"].isin(m_cids)]
+    lab_cids = metadata.groupby("lab_name")["measurement_concept_id"].apply(sorted)
+
+    if measurement is None:
+        measurement = measurement_data(metadata["measurement_concept_id"].tolist())
+    harmonized = harmonize(preprocess(measurement), metadata, unit_map, unit_convert, nan_equivalents)
+    final = trim(harmonized)
+    del harmonized
+
+    results = {}
+    for lab_name, lab_df in final.groupby("lab_name", observed=True):
+        lab_df = lab_df.reset_index(drop=True)
+        cids = lab_cids[lab_name]
+        pid_summary = pid_level_summary(cids, lab_df, save_file=False)
+
+        if save_file:
+            m_cids_str = str(cids).replace('[','').replace(']','').replace(', ','_')
+            lab_df.to_csv(os.path.join(output_dir, f"measurement_{m_cids_str}.csv"), index=False)
+            pid_summary.to_csv(os.path.join(output_dir, f"measurement_{m_cids_str}_summary.csv"), index=False)
+
+        results[lab_name] = {"final": lab_df, "pid_summary": pid_summary}
+
+    print(f"Harmonized {len(results)} labs, {len(final)} measurements kept.")
+
+    return results
@@ -9,13 +9,18 @@ import shutil
 import time
 from datetime import datetime
 
+from query_cache import cached_query
+
 client = bigquery.Client()
 
-def client_read_gbq(query, dataset = os.getenv('WORKSPACE_CDR')):
+def client_read_gbq(query, dataset = os.getenv('WORKSPACE_CDR'), use_cache = True):
     
-    job_config = bigquery.QueryJobConfig(default_dataset=dataset)
-    query_job = client.query(query, job_config =job_config)  # API request
-    df = query_job.result().to_dataframe()
+    def run_query():
+        job_config = bigquery.QueryJobConfig(default_dataset=dataset)
+        query_job = client.query(query, job_config =job_config)  # API request
+        return query_job.result().to_dataframe()
+
+    df = cached_query(query, dataset, run_query, use_cache)
 
     return df
 
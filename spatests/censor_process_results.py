@@ -1,25 +1,19 @@
 import pandas as pd
+import numpy as np
+import argparse
 import json
 import gzip
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-# Load the phenotype mapping from JSON
-with open("../updated_pilot_phenotypes_with_phecode.json") as f:
-    phenotype_data = json.load(f)
-
-# Create mappings from phecode to phenotype_ID and sex specificity
-phecode_to_id = {}
-phecode_to_sex = {}
-
-for entry in phenotype_data:
-    phecodes = str(entry.get("phecode", "")).split(", ")  # Ensure it's a string
-    for phecode in phecodes:
-        if phecode:  # Skip empty values
-            phecode_to_id[phecode] = entry["phenotype_ID"]
-            sex_spec = entry["sex_specific_run"].strip().lower()
-            if sex_spec in ["male", "female"]:
-                phecode_to_sex[phecode] = sex_spec
-            else:
-                phecode_to_sex[phecode] = "FALSE"  # Default to FALSE
+from combine_and_sort_results import sort_key, key_field, merge_readers, filtered_reader
+from manifest import manifest_path, load_manifest, write_manifest, scan_files, removed_files
+from result_store import open_store, read_store, combine_filter, parse_filename
+from step2_schema import read_step2, is_group_test
+
+phenotype_file = "../updated_pilot_phenotypes_with_phecode.json"
 
 # Read the input file
 input_file = "combined_sorted_results.txt"
@@ -30,26 +24,260 @@ columns_to_keep = [
     "MarkerID", "AC_Allele2", "p.value", "BETA", "SE", "Is.SPA", "Tstat",
     "var", "N", "N_case", "N_ctrl", "Ancestry", "Trait", "phecode", "VariantClass"
 ]
+output_columns = columns_to_keep + ["Sex_Specific"]
+
+# Group-test rows (one per gene, mask and max_MAF) have no marker columns of their own; these
+# identify and describe them, and are released when the combined results include group tests
+group_columns = [
+    "Region", "Group", "max_MAF", "MAC", "Pvalue", "Pvalue_Burden", "Pvalue_SKAT", "BETA_Burden", "SE_Burden"
+]
+
+
+def release_columns(log10p=False, group_test=False):
+    # LOG10P (exact -log10 p, also for p-values that underflow to 0) is only released on request
+    columns = list(output_columns)
+    if group_test:
+        at = columns.index("MarkerID") + 1
+        columns[at:at] = group_columns
+    if log10p:
+        columns.insert(columns.index("p.value") + 1, "LOG10P")
+    return columns
+
+
+def p_value_key(value):
+    # Merge key for releases without LOG10P: ascending p.value, missing values last
+    try:
+        p = float(value)
+    except ValueError:
+        p = np.nan
+    if np.isnan(p):
+        return (1, 0.0)
+    with np.errstate(divide="ignore"):
+        return (0, np.log10(p))
+
+
+def load_phenotype_maps(path):
+    # Load the phenotype mapping from JSON
+    with open(path) as f:
+        phenotype_data = json.load(f)
+
+    # Create mappings from phecode to phenotype_ID and sex specificity
+    phecode_to_id = {}
+    phecode_to_sex = {}
+
+    for entry in phenotype_data:
+        phecodes = str(entry.get("phecode", "")).split(", ")  # Ensure it's a string
+        for phecode in phecodes:
+            if phecode:  # Skip empty values
+                phecode_to_id[phecode] = entry["phenotype_ID"]
+                sex_spec = entry["sex_specific_run"].strip().lower()
+                if sex_spec in ["male", "female"]:
+                    phecode_to_sex[phecode] = sex_spec
+                else:
+                    phecode_to_sex[phecode] = "FALSE"  # Default to FALSE
+
+    return phecode_to_id, phecode_to_sex
+
+
+def censor(df, phecode_to_id, phecode_to_sex, columns=output_columns):
+    # Censor allele counts (AC_Allele2, MAC of group tests) less than 40
+    for col in ["AC_Allele2", "MAC"]:
+        if col in df.columns:
+            ac = df[col]
+            df[col] = np.where(ac.notna() & (ac < 40), "<40", ac.astype(object))
+
+    # Preserve the original phecode column
+    phecode = df["Trait"].astype("category")
+    df["phecode"] = phecode
+
+    # Map each distinct phecode once, then expand through the category codes
+    categories = phecode.cat.categories
+    to_id = {cat: phecode_to_id.get(str(cat), cat) for cat in categories}
+    to_sex = {cat: phecode_to_sex.get(str(cat), "FALSE") for cat in categories}
+
+    # Replace phecode with phenotype_ID
+    df["Trait"] = phecode.map(to_id).astype(object).fillna("UNKNOWN")
+
+    # Assign sex specificity based on phecode
+    df["Sex_Specific"] = phecode.map(to_sex).astype(object).fillna("FALSE")
+
+    # Select only necessary columns
+    return df[columns]
+
+
+class ParallelGzipWriter:
+    # Text sink that compresses fixed-size blocks on a thread pool and writes them
+    # in order as concatenated gzip members (readable by zcat, gzip and pandas)
+
+    def __init__(self, path, threads=None, block_size=8 << 20, level=6):
+        self.file = open(path, "wb")
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.block_size = block_size
+        self.level = level
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self.buffer).encode()
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.submit(gzip.compress, data, self.level))
+
+        # Bound memory by the number of blocks in flight
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffer:
+            self._submit()
+        for future in self.pending:
+            self.file.write(future.result())
+        self.pending = []
+        self.pool.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_release(chunks, output_file, phecode_to_id, phecode_to_sex, threads=None, columns=output_columns):
+    with ParallelGzipWriter(output_file, threads) as out:
+        out.write("\t".join(columns) + "\n")
+        for chunk in chunks:
+            out.write(censor(chunk, phecode_to_id, phecode_to_sex, columns).to_csv(sep="\t", index=False, header=False))
+
+
+def release_manifest():
+    # The release depends on the combined inputs and on the phenotype mapping
+    combined = load_manifest(manifest_path(input_file))
+    if combined is None:
+        return None
+    entries, _ = scan_files([phenotype_file], load_manifest(manifest_path(output_file)))
+    entries.update(combined)
+    return entries
+
+
+def stale_runs(entries, previous):
+    # Runs whose combined inputs were added, changed or removed since the last release
+    stale = set()
+    for path, entry in entries.items():
+        old = previous.get(path)
+        if old is None or old["sha256"] != entry["sha256"]:
+            stale.add(path)
+    stale.update(removed_files(entries, previous))
+    return {parse_filename(path) for path in stale if path != phenotype_file}
+
+
+def process_incremental(entries, previous, phecode_to_id, phecode_to_sex, chunksize=1000000, threads=None,
+                        columns=output_columns):
+    stale = stale_runs(entries, previous)
+    if not stale:
+        print("No new or changed runs; release file is up to date.")
+        return
+
+    print(f"Re-processing {len(stale)} new or changed runs.")
+    meta = ["Ancestry", "Trait", "VariantClass"]
+    # Rows are merged on LOG10P when the release has it, else on p.value (ties at p = 0)
+    key = sort_key if "LOG10P" in columns else p_value_key
+    if "LOG10P" in columns:
+        key_index = columns.index("LOG10P")
+    else:
+        key_index = [columns.index(col) for col in ["p.value", "Pvalue"] if col in columns]
+    meta_index = [columns.index(col) for col in ["Ancestry", "phecode", "VariantClass"]]
+
+    tmp_dir = tempfile.mkdtemp(prefix="censor_", dir=".")
+    try:
+        # Rows for the stale runs, still in LOG10P order as in the combined file
+        new_rows = os.path.join(tmp_dir, "new_rows.txt")
+        with open(new_rows, "w") as out:
+            reader = read_step2(input_file, chunksize=chunksize)
+            for chunk in reader:
+                keep = pd.MultiIndex.from_arrays([chunk[col] for col in meta]).isin(list(stale))
+                if keep.any():
+                    censor(chunk[keep].copy(), phecode_to_id, phecode_to_sex, columns).to_csv(
+                        out, sep="\t", index=False, header=False
+                    )
+
+        tmp_output = os.path.join(tmp_dir, "release.txt.gz")
+        with open(new_rows) as rows, gzip.open(output_file, "rt") as existing, ParallelGzipWriter(tmp_output, threads) as out:
+            next(existing)
+            out.write("\t".join(columns) + "\n")
+            readers = [
+                ((key(key_field(line.rstrip("\n").split("\t"), key_index)), line) for line in rows),
+                filtered_reader(existing, key_index, meta_index, stale, key),
+            ]
+            merge_readers(readers, out)
+        shutil.move(tmp_output, output_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Censor and annotate the combined results for release")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of combined_sorted_results.txt")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-process runs that changed since the last release, using the combine manifest")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows processed per chunk")
+    parser.add_argument("--threads", type=int, default=None, help="Compression threads (default: all cores)")
+    parser.add_argument("--log10p", action="store_true", help="Also release LOG10P (-log10 p, exact below float64 range)")
+    args = parser.parse_args()
+
+    if args.parquet:
+        input_columns = open_store(args.parquet).schema.names
+    else:
+        input_columns = pd.read_csv(input_file, sep="\t", nrows=0).columns
+    columns = release_columns(args.log10p, is_group_test(input_columns))
 
-# Read the file while handling missing or extra spaces in the header
-df = pd.read_csv(input_file, sep="\t")
+    phecode_to_id, phecode_to_sex = load_phenotype_maps(phenotype_file)
 
-# Censor AC_Allele2 values less than 40
-df["AC_Allele2"] = df["AC_Allele2"].apply(lambda x: "<40" if pd.notna(x) and x < 40 else x)
+    entries = release_manifest() if args.incremental and not args.parquet else None
+    previous = load_manifest(manifest_path(output_file)) if os.path.exists(output_file) else None
+    phenotypes_unchanged = (
+        entries is not None and previous is not None and phenotype_file in previous
+        and previous[phenotype_file]["sha256"] == entries[phenotype_file]["sha256"]
+    )
 
-# Preserve the original phecode column
-df["phecode"] = df["Trait"]
+    # A release written with a different column layout cannot be merged into
+    if phenotypes_unchanged:
+        with gzip.open(output_file, "rt") as f:
+            phenotypes_unchanged = f.readline().rstrip("\n").split("\t") == columns
 
-# Replace phecode with phenotype_ID
-df["Trait"] = df["phecode"].apply(lambda x: phecode_to_id.get(str(x), x) if pd.notna(x) else "UNKNOWN")
+    if phenotypes_unchanged:
+        process_incremental(entries, previous, phecode_to_id, phecode_to_sex, args.chunksize, args.threads, columns)
+    else:
+        if args.incremental and entries is None:
+            print(f"No manifest for {input_file}; run combine_and_sort_results.py --incremental first. Processing everything.")
 
-# Assign sex specificity based on phecode
-df["Sex_Specific"] = df["phecode"].apply(lambda x: phecode_to_sex.get(str(x), "FALSE") if pd.notna(x) else "FALSE")
+        if args.parquet:
+            # Read only the released columns of the rows that pass the combine filters
+            df = read_store(
+                args.parquet,
+                columns=[col for col in columns if col not in ["phecode", "Sex_Specific", "LOG10P"]] + ["LOG10P"],
+                filter=combine_filter(open_store(args.parquet)),
+            ).sort_values(by="LOG10P", ascending=False)
+            chunks = (df.iloc[i:i + args.chunksize].copy() for i in range(0, len(df), args.chunksize))
+        else:
+            # Stream the file in chunks so memory does not grow with the result size
+            chunks = read_step2(input_file, chunksize=args.chunksize)
 
-# Select only necessary columns
-df = df[columns_to_keep + ["Sex_Specific"]]
+        # Save as gzipped file
+        write_release(chunks, output_file, phecode_to_id, phecode_to_sex, args.threads, columns)
 
-# Save as gzipped file
-df.to_csv(output_file, sep="\t", index=False, compression="gzip")
+    if entries is not None:
+        write_manifest(entries, manifest_path(output_file))
+    elif os.path.exists(manifest_path(output_file)):
+        # The release was rebuilt outside the manifest, so it no longer describes it
+        os.remove(manifest_path(output_file))
 
-print(f"Processed data saved to {output_file}")
+    print(f"Processed data saved to {output_file}")
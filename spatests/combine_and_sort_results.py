@@ -1,55 +1,258 @@
 import pandas as pd
-import glob
-import re
+import numpy as np
+import argparse
+import heapq
+import os
+import shutil
+import tempfile
+from functools import partial
 
-# Define the file pattern
-file_pattern = "aou_snp_*_step2_*_vars_*.txt"
-files = [f for f in glob.glob(file_pattern) if "ADDITIVE" not in f]
+from manifest import manifest_path, load_manifest, write_manifest, scan_files, removed_files
+from reader_pool import meta_columns, read_filtered, iter_filtered, map_files
+from result_store import list_result_files, parse_filename, read_store, open_store, combine_filter
+from step2_schema import concat_frames, with_log10p
 
+output_file = "combined_sorted_results.txt"
 
-dfs = []
 
-# Process each file
-for file in files:
-    # Extract ancestry, trait, and variant class from filename
-    match = re.search(r'aou_snp_(.*?)_step2_(.*?)_vars_(.*?)\.txt', file)
-    if not match:
-        continue
-    ancestry, trait, variant_class = match.groups()
+def combine_in_memory(files, output_file, processes=None):
+    # Parse and filter the files in worker processes; only surviving rows come back
+    files = [f for f in files if parse_filename(f) is not None]
+    dfs = list(map_files(read_filtered, files, processes))
 
-    # Read file
-    df = pd.read_csv(file, sep="\t")
+    # Combine all dataframes
+    combined_df = concat_frames(dfs)
 
-    # Add extracted metadata as new columns
-    df["Ancestry"] = ancestry
-    df["Trait"] = trait
-    df["VariantClass"] = variant_class
+    # Sort by p.value (ascending), using -log10(p) so underflowed p-values keep their order
+    sorted_df = combined_df.sort_values(by="LOG10P", ascending=False)
 
-    # Apply filtering if columns exist
-    df = df[df["AC_Allele2"] >= 10]
+    # Save to a new file
+    sorted_df.to_csv(output_file, sep="\t", index=False)
 
-    if "N_case" in df.columns:
-        df["N_case"] = pd.to_numeric(df["N_case"], errors="coerce")
-        df = df[df["N_case"] >= 100]
 
-    if "AF_Allele2" in df.columns:
-        df["AF_Allele2"] = pd.to_numeric(df["AF_Allele2"], errors="coerce")
-        df = df[df["AF_Allele2"] < 0.5]  # Keep only if AF_Allele2 < 0.5
+def combine_from_store(store, output_file):
+    # Filters are pushed down to the Parquet row groups instead of scanning text
+    combined_df = read_store(store, filter=combine_filter(open_store(store)))
 
+    sorted_df = combined_df.sort_values(by="LOG10P", ascending=False)
+    sorted_df.to_csv(output_file, sep="\t", index=False)
 
-    dfs.append(df)
 
-# Combine all dataframes
-combined_df = pd.concat(dfs, ignore_index=True)
+def union_columns(files):
+    # Same column order pd.concat would produce, read from the headers only
+    columns = []
+    for file in files:
+        header = with_log10p(pd.read_csv(file, sep="\t", nrows=0).columns)
+        for col in header + meta_columns:
+            if col not in columns:
+                columns.append(col)
+    return columns
 
-# Convert p.value to numeric (handle potential errors)
-combined_df["p.value"] = pd.to_numeric(combined_df["p.value"], errors="coerce")
 
-# Sort by p.value (ascending)
-sorted_df = combined_df.sort_values(by="p.value", ascending=True)
+def flush_run(buffer, columns, run_dir, runs, prefix="run"):
+    # Sort the buffered rows and write them out as one sorted run
+    df = concat_frames(buffer)
+    df = df.sort_values(by="LOG10P", ascending=False).reindex(columns=columns)
 
-# Save to a new file
-sorted_df.to_csv("combined_sorted_results.txt", sep="\t", index=False)
+    run_file = os.path.join(run_dir, f"{prefix}_{len(runs):06d}.txt")
+    df.to_csv(run_file, sep="\t", index=False, header=False)
+    runs.append(run_file)
 
-print("Files merged and sorted. Output saved as 'combined_sorted_results.txt'.")
 
+def buffer_runs(chunks, columns, run_dir, buffer_rows, runs, prefix="run"):
+    # Buffer filtered chunks and flush a sorted run whenever buffer_rows is reached, so at
+    # most buffer_rows rows plus one chunk are held at a time
+    buffer = []
+    buffered = 0
+    for df in chunks:
+        if df.empty:
+            continue
+        buffer.append(df)
+        buffered += len(df)
+
+        if buffered >= buffer_rows:
+            flush_run(buffer, columns, run_dir, runs, prefix)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        flush_run(buffer, columns, run_dir, runs, prefix)
+
+    return runs
+
+
+def file_runs(file, columns, run_dir, buffer_rows):
+    # Worker: write one file's filtered rows as sorted runs and return only the run names
+    prefix = f"run_{os.path.splitext(os.path.basename(file))[0]}"
+    return buffer_runs(iter_filtered(file, buffer_rows), columns, run_dir, buffer_rows, [], prefix)
+
+
+def write_sorted_runs(files, columns, run_dir, buffer_rows, processes=1):
+    files = [f for f in files if parse_filename(f) is not None]
+
+    # Sequential: one buffer across all files, filled chunk by chunk
+    if (processes or os.cpu_count()) <= 1:
+        chunks = (chunk for file in files for chunk in iter_filtered(file, buffer_rows))
+        return buffer_runs(chunks, columns, run_dir, buffer_rows, [])
+
+    # Parallel: each worker buffers its own file, so memory is bounded by
+    # processes x buffer_rows and only run file names come back to the parent
+    runs = []
+    worker = partial(file_runs, columns=columns, run_dir=run_dir, buffer_rows=buffer_rows)
+    for file_run_list in map_files(worker, files, processes):
+        runs.extend(file_run_list)
+    return runs
+
+
+def sort_key(value):
+    # Largest -log10(p) first; missing values sort last, like NaN in pandas
+    try:
+        log10p = float(value)
+    except ValueError:
+        log10p = np.nan
+    return (1, 0.0) if np.isnan(log10p) else (0, -log10p)
+
+
+def run_reader(run_file, key_index):
+    # Yield (sort key, line) pairs from a sorted run
+    with open(run_file) as f:
+        for line in f:
+            yield sort_key(line.rstrip("\n").split("\t")[key_index]), line
+
+
+def key_field(fields, key_index):
+    # Sort field of a row; with several key columns (e.g. p.value, then Pvalue for group-test
+    # rows) the first non-empty one
+    if isinstance(key_index, int):
+        return fields[key_index]
+    return next((fields[i] for i in key_index if fields[i] != ""), "")
+
+
+def filtered_reader(lines, key_index, meta_index, stale, key=sort_key):
+    # Yield rows of a previous sorted output, skipping runs that are being replaced
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if tuple(fields[i] for i in meta_index) in stale:
+            continue
+        yield key(key_field(fields, key_index)), line
+
+
+def merge_readers(readers, out):
+    for _, line in heapq.merge(*readers, key=lambda item: item[0]):
+        out.write(line)
+
+
+def reduce_runs(runs, key_index, run_dir, max_open_runs):
+    # Merge in several passes if there are more runs than we want open at once
+    while len(runs) > max_open_runs:
+        merged = []
+        for i in range(0, len(runs), max_open_runs):
+            group = runs[i:i + max_open_runs]
+            merged_file = os.path.join(run_dir, f"pass_{len(merged):06d}_{os.path.basename(group[0])}")
+            with open(merged_file, "w") as out:
+                merge_readers([run_reader(run, key_index) for run in group], out)
+            for run in group:
+                os.remove(run)
+            merged.append(merged_file)
+        runs = merged
+    return runs
+
+
+def combine_streaming(files, output_file, buffer_rows, max_open_runs, tmp_dir=None, processes=1):
+    columns = union_columns([f for f in files if parse_filename(f) is not None])
+    key_index = columns.index("LOG10P")
+
+    run_dir = tempfile.mkdtemp(prefix="combine_runs_", dir=tmp_dir)
+    try:
+        runs = write_sorted_runs(files, columns, run_dir, buffer_rows, processes)
+        runs = reduce_runs(runs, key_index, run_dir, max_open_runs)
+
+        with open(output_file, "w") as out:
+            out.write("\t".join(columns) + "\n")
+            merge_readers([run_reader(run, key_index) for run in runs], out)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def combine_incremental(files, output_file, buffer_rows, max_open_runs, tmp_dir=None, processes=1):
+    files = [f for f in files if parse_filename(f) is not None]
+    manifest_file = manifest_path(output_file)
+    previous = load_manifest(manifest_file) if os.path.exists(output_file) else None
+    entries, changed = scan_files(files, previous)
+    removed = removed_files(entries, previous)
+
+    columns = union_columns(files)
+    existing_columns = None
+    if previous is not None:
+        existing_columns = pd.read_csv(output_file, sep="\t", nrows=0).columns.tolist()
+
+    if existing_columns != columns:
+        # No usable previous output (or the column layout changed): rebuild from scratch
+        print(f"Recombining all {len(files)} files.")
+        combine_streaming(files, output_file, buffer_rows, max_open_runs, tmp_dir, processes)
+        write_manifest(entries, manifest_file)
+        return
+
+    if not changed and not removed:
+        print("No new or changed files; combined output is up to date.")
+        return
+
+    print(f"Merging {len(changed)} new or changed files, dropping {len(removed)} removed files.")
+    stale = {parse_filename(f) for f in changed + removed}
+    key_index = columns.index("LOG10P")
+
+    run_dir = tempfile.mkdtemp(prefix="combine_runs_", dir=tmp_dir)
+    try:
+        runs = write_sorted_runs(changed, columns, run_dir, buffer_rows, processes)
+        runs = reduce_runs(runs, key_index, run_dir, max(max_open_runs - 1, 2))
+
+        # The previous output is already sorted, so it is merged as one more run
+        meta_index = [columns.index(col) for col in meta_columns]
+        tmp_output = os.path.join(run_dir, "combined.txt")
+        with open(output_file) as existing, open(tmp_output, "w") as out:
+            next(existing)
+            out.write("\t".join(columns) + "\n")
+            readers = [run_reader(run, key_index) for run in runs]
+            readers.append(filtered_reader(existing, key_index, meta_index, stale))
+            merge_readers(readers, out)
+        shutil.move(tmp_output, output_file)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    write_manifest(entries, manifest_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combine SAIGE step2 results and sort by p.value")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Sort each file into on-disk runs and k-way merge them, bounding memory by --buffer_rows")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-read new or changed files, tracked in a manifest next to the output")
+    parser.add_argument("--buffer_rows", type=int, default=1000000,
+                        help="Rows held in memory before a sorted run is written (streaming/incremental mode)")
+    parser.add_argument("--max_open_runs", type=int, default=256,
+                        help="Maximum runs merged at once (streaming/incremental mode)")
+    parser.add_argument("--tmp_dir", default=None, help="Directory for sorted runs (streaming/incremental mode)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes parsing and filtering the text files (default: all cores in memory, "
+                             "1 in streaming/incremental mode, where each worker holds up to --buffer_rows rows)")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of the text files")
+    parser.add_argument("--output", default=output_file, help="Output file")
+    args = parser.parse_args()
+
+    files = list_result_files()
+
+    if args.parquet:
+        combine_from_store(args.parquet, args.output)
+    elif args.incremental:
+        combine_incremental(files, args.output, args.buffer_rows, args.max_open_runs, args.tmp_dir, args.processes or 1)
+    elif args.streaming:
+        combine_streaming(files, args.output, args.buffer_rows, args.max_open_runs, args.tmp_dir, args.processes or 1)
+    else:
+        combine_in_memory(files, args.output, args.processes)
+
+    if not args.incremental and os.path.exists(manifest_path(args.output)):
+        # The output was rebuilt outside the manifest, so it no longer describes it
+        os.remove(manifest_path(args.output))
+
+    print(f"Files merged and sorted. Output saved as '{args.output}'.")
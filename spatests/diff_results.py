@@ -0,0 +1,117 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+import shutil
+import tempfile
+
+from step2_schema import read_step2, is_group_test
+
+output_file = "results_diff.tsv"
+
+# Runs are hash-partitioned on the association key (gene, trait, ancestry, variant class; the
+# gene is Region for group tests), so every row of an association lands in the same partition
+key_columns = ["MarkerID", "Trait", "Ancestry", "VariantClass"]
+
+# Rows are then joined on the key plus the marker (single-variant) or mask and max_MAF (group test)
+marker_columns = ["CHR", "POS", "Allele1", "Allele2"]
+group_key_columns = ["Region", "Group", "max_MAF"]
+
+diff_columns = ["status", "LOG10P_old", "LOG10P_new", "delta_LOG10P", "BETA_old", "BETA_new", "delta_BETA"]
+
+
+def run_columns(path):
+    header = pd.read_csv(path, sep="\t", nrows=0).columns
+    keys = key_columns + [col for col in marker_columns if col in header]
+    if is_group_test(header):
+        keys += group_key_columns
+    values = ["LOG10P"] + [col for col in ["BETA", "BETA_Burden"] if col in header]
+    return keys, values
+
+
+def partition_run(path, keys, values, part_dir, n_partitions, chunksize):
+    # Split a combined file into n_partitions files by a hash of the association key
+    os.makedirs(part_dir)
+    for chunk in read_step2(path, columns=keys + values, chunksize=chunksize):
+        chunk = chunk.reindex(columns=keys + values)
+        hashed = [col for col in key_columns + ["Region"] if col in keys]
+        part = pd.util.hash_pandas_object(chunk[hashed].astype(str), index=False).to_numpy() % n_partitions
+        for i, rows in chunk.groupby(part, sort=False):
+            rows.to_csv(os.path.join(part_dir, f"part_{i:04d}.txt"), sep="\t", index=False, header=False, mode="a")
+
+
+def read_partition(part_dir, i, keys, values):
+    part_file = os.path.join(part_dir, f"part_{i:04d}.txt")
+    columns = keys + values
+    if not os.path.exists(part_file):
+        return pd.DataFrame(columns=columns)
+    df = pd.read_csv(part_file, sep="\t", names=columns, dtype={col: str for col in keys})
+    # Burden effect sizes are compared as BETA (a combined file may hold both layouts)
+    if "BETA_Burden" in df.columns:
+        df["BETA"] = df["BETA"].fillna(df["BETA_Burden"]) if "BETA" in df.columns else df["BETA_Burden"]
+        df = df.drop(columns="BETA_Burden")
+    return df
+
+
+def diff_partition(old, new, keys, min_log10p_shift, min_beta_shift):
+    merged = old.merge(new, on=keys, how="outer", suffixes=("_old", "_new"), indicator=True)
+    for col in ["LOG10P", "BETA"]:
+        for side in ["old", "new"]:
+            if f"{col}_{side}" not in merged.columns:
+                merged[f"{col}_{side}"] = np.nan
+        merged[f"delta_{col}"] = merged[f"{col}_new"] - merged[f"{col}_old"]
+
+    shifted = (merged["delta_LOG10P"].abs() >= min_log10p_shift) | (merged["delta_BETA"].abs() >= min_beta_shift)
+    merged["status"] = np.select(
+        [merged["_merge"] == "right_only", merged["_merge"] == "left_only", shifted],
+        ["added", "removed", "shifted"],
+        default="",
+    )
+    return merged.loc[merged["status"] != "", keys + diff_columns]
+
+
+def diff_runs(old_file, new_file, output_file, n_partitions=64, chunksize=1000000,
+              min_log10p_shift=1.0, min_beta_shift=0.5, tmp_dir=None):
+    old_keys, old_values = run_columns(old_file)
+    new_keys, new_values = run_columns(new_file)
+    keys = old_keys + [col for col in new_keys if col not in old_keys]
+
+    work_dir = tempfile.mkdtemp(prefix="diff_parts_", dir=tmp_dir)
+    counts = {"added": 0, "removed": 0, "shifted": 0}
+    try:
+        partition_run(old_file, keys, old_values, os.path.join(work_dir, "old"), n_partitions, chunksize)
+        partition_run(new_file, keys, new_values, os.path.join(work_dir, "new"), n_partitions, chunksize)
+
+        # Only one partition of each run is in memory at a time
+        with open(output_file, "w") as out:
+            out.write("\t".join(keys + diff_columns) + "\n")
+            for i in range(n_partitions):
+                old = read_partition(os.path.join(work_dir, "old"), i, keys, old_values)
+                new = read_partition(os.path.join(work_dir, "new"), i, keys, new_values)
+                diff = diff_partition(old, new, keys, min_log10p_shift, min_beta_shift)
+                diff.to_csv(out, sep="\t", index=False, header=False)
+                for status, n in diff["status"].value_counts().items():
+                    counts[status] += n
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two combined result files: added, removed and shifted associations")
+    parser.add_argument("old", help="Combined results of the previous run")
+    parser.add_argument("new", help="Combined results of the new run")
+    parser.add_argument("--min_log10p_shift", type=float, default=1.0, help="Report associations whose -log10(p) moved by at least this")
+    parser.add_argument("--min_beta_shift", type=float, default=0.5, help="Report associations whose BETA moved by at least this")
+    parser.add_argument("--partitions", type=int, default=64, help="Hash partitions; memory holds one partition of each run")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows read per chunk")
+    parser.add_argument("--tmp_dir", default=None, help="Directory for the partition files")
+    parser.add_argument("--output", default=output_file, help="Output file")
+    args = parser.parse_args()
+
+    counts = diff_runs(
+        args.old, args.new, args.output, args.partitions, args.chunksize,
+        args.min_log10p_shift, args.min_beta_shift, args.tmp_dir,
+    )
+    print(f"{counts['added']} added, {counts['removed']} removed, {counts['shifted']} shifted associations saved to {args.output}")
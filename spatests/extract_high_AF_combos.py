@@ -1,41 +1,64 @@
 import pandas as pd
+import argparse
 import glob
 import re
 
-# Define the file pattern (excluding ADDITIVE)
-file_pattern = "aou_snp_*_step2_*_vars_*.txt"
-files = glob.glob(file_pattern)
+import pyarrow.dataset as ds
 
-# Set to store unique combinations
-unique_combos = set()
+from reader_pool import read_high_af, map_files
+from result_store import open_store, read_store
 
-# Process each file
-for file in files:
-    # Extract ancestry, trait, and variant class from filename
-    match = re.search(r'aou_snp_(.*?)_step2_(.*?)_vars_(.*?)\.txt', file)
-    if not match:
-        continue
-    ancestry, trait, variant_class = match.groups()
+# Guarded so the reader pool's worker processes can import this script safely
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract gene/ancestry/variant class combos with AF_Allele2 >= 0.5")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of the text files")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes parsing the text files (default: all cores, 1 reads sequentially)")
+    args = parser.parse_args()
+
+    # Define the file pattern (excluding ADDITIVE)
+    file_pattern = "aou_snp_*_step2_*_vars_*.txt"
+    files = [] if args.parquet else glob.glob(file_pattern)
+
+    # Set to store unique combinations
+    unique_combos = set()
 
-    # Read file
-    df = pd.read_csv(file, sep="\t")
+    if args.parquet:
+        # Check if required columns exist
+        columns = open_store(args.parquet).schema.names
+        if "MarkerID" not in columns or "AF_Allele2" not in columns:
+            print(f"Skipping {args.parquet}: Missing required columns.")
+        else:
+            # Only the three needed columns are read, and only row groups with AF_Allele2 >= 0.5
+            df = read_store(
+                args.parquet,
+                columns=["MarkerID", "Ancestry", "VariantClass"],
+                filter=ds.field("AF_Allele2") >= 0.5,
+            ).drop_duplicates()
+            unique_combos.update(zip(df["MarkerID"], df["Ancestry"], df["VariantClass"]))
+
+    # Extract ancestry, trait, and variant class from filename
+    matches = [(file, re.search(r'aou_snp_(.*?)_step2_(.*?)_vars_(.*?)\.txt', file)) for file in files]
+    matches = [(file, match) for file, match in matches if match]
 
-    # Check if required columns exist
-    if "MarkerID" not in df.columns or "AF_Allele2" not in df.columns:
-        print(f"Skipping {file}: Missing required columns.")
-        continue
+    # Files are parsed in worker processes, which send back only the genes with AF_Allele2 >= 0.5
+    genes_per_file = map_files(read_high_af, [file for file, _ in matches], args.processes)
+    for (file, match), genes in zip(matches, genes_per_file):
+        ancestry, trait, variant_class = match.groups()
 
-    # Filter for AF_Allele2 >= 0.5
-    filtered_df = df[df["AF_Allele2"] >= 0.5]
+        # Check if required columns exist
+        if genes is None:
+            print(f"Skipping {file}: Missing required columns.")
+            continue
 
-    # Extract unique gene + ancestry + variant class
-    for gene in filtered_df["MarkerID"].unique():
-        unique_combos.add((gene, ancestry, variant_class))
+        # Extract unique gene + ancestry + variant class
+        for gene in genes:
+            unique_combos.add((gene, ancestry, variant_class))
 
-# Convert set to DataFrame
-output_df = pd.DataFrame(unique_combos, columns=["Gene", "Ancestry", "VariantClass"])
+    # Convert set to DataFrame
+    output_df = pd.DataFrame(unique_combos, columns=["Gene", "Ancestry", "VariantClass"])
 
-# Save to file
-output_df.to_csv("high_AF_combos.txt", sep="\t", index=False)
+    # Save to file
+    output_df.to_csv("high_AF_combos.txt", sep="\t", index=False)
 
-print("Extraction complete. Results saved in 'high_AF_combos.txt'.")
+    print("Extraction complete. Results saved in 'high_AF_combos.txt'.")
@@ -0,0 +1,130 @@
+import pandas as pd
+import argparse
+import os
+import sqlite3
+import sys
+
+# Built from the release file written by censor_process_results.py
+input_file = "aou_recessive_combined_results.txt.gz"
+index_file = "aou_recessive_combined_results.sqlite"
+
+# Lookups are by gene (optionally within a trait) or by phecode / trait; group-test rows
+# carry the gene in Region instead of MarkerID
+indexes = {
+    "idx_gene_trait": ["MarkerID", "Trait"],
+    "idx_region_trait": ["Region", "Trait"],
+    "idx_phecode": ["phecode"],
+    "idx_trait": ["Trait"],
+}
+
+# LOG10P is only in releases written with --log10p, Pvalue only with group-test results
+p_value_columns = ["p.value", "Pvalue", "LOG10P"]
+
+
+def quote(col):
+    return '"' + col.replace('"', '""') + '"'
+
+
+def build_index(input_file=input_file, index_file=index_file, chunksize=1000000):
+    # Build into a temporary file so a failed build never replaces a working index
+    tmp_file = index_file + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    con = sqlite3.connect(tmp_file)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+
+    # Keep the release text as-is (censored "<40" counts, TRUE/FALSE flags); only the
+    # p-value columns are numeric, for ordering and thresholds
+    rows = 0
+    columns = []
+    for chunk in pd.read_csv(input_file, sep="\t", dtype=str, keep_default_na=False, chunksize=chunksize):
+        columns = chunk.columns
+        for col in p_value_columns:
+            if col in columns:
+                chunk[col] = pd.to_numeric(chunk[col], errors="coerce")
+        chunk.to_sql("results", con, if_exists="append", index=False)
+        rows += len(chunk)
+
+    for name, cols in indexes.items():
+        if not all(col in columns for col in cols):
+            continue
+        con.execute(f"CREATE INDEX {name} ON results ({', '.join(quote(col) for col in cols)})")
+    con.execute("ANALYZE")
+    con.commit()
+    con.close()
+
+    os.replace(tmp_file, index_file)
+    print(f"Indexed {rows} rows into {index_file}")
+
+
+def p_value_expr(columns):
+    # Single-variant rows have p.value, group-test rows Pvalue (the other one is NULL)
+    present = [quote(col) for col in ["p.value", "Pvalue"] if col in columns]
+    return present[0] if len(present) == 1 else f"COALESCE({', '.join(present)})"
+
+
+def query_index(index_file=index_file, gene=None, trait=None, phecode=None, ancestry=None, max_p=None):
+    with sqlite3.connect(f"file:{index_file}?mode=ro", uri=True) as con:
+        # A quoted name that is not a column is read as a string literal, so only refer to
+        # columns the release actually has
+        columns = [row[1] for row in con.execute("PRAGMA table_info(results)")]
+        p_value = p_value_expr(columns)
+
+        conditions = []
+        params = []
+        if gene is not None:
+            if "Region" in columns:
+                conditions.append(f"({quote('MarkerID')} = ? OR {quote('Region')} = ?)")
+                params += [gene, gene]
+            else:
+                conditions.append(f"{quote('MarkerID')} = ?")
+                params.append(gene)
+        for col, value in [("Trait", trait), ("phecode", phecode), ("Ancestry", ancestry)]:
+            if value is not None:
+                conditions.append(f"{quote(col)} = ?")
+                params.append(value)
+        if max_p is not None:
+            conditions.append(f"{p_value} < ?")
+            params.append(max_p)
+
+        sql = "SELECT * FROM results"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if "LOG10P" in columns:
+            sql += f" ORDER BY {quote('LOG10P')} DESC"
+        else:
+            sql += f" ORDER BY {p_value} ASC"
+
+        return pd.read_sql_query(sql, con, params=params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Indexed gene / phecode lookups over the combined association results")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Build the index from the release file")
+    build.add_argument("--input", default=input_file, help="Release file from censor_process_results.py")
+    build.add_argument("--index", default=index_file, help="SQLite index file to write")
+    build.add_argument("--chunksize", type=int, default=1000000, help="Rows loaded per chunk")
+
+    query = subparsers.add_parser("query", help="Look up results for a gene, phecode or trait")
+    query.add_argument("--index", default=index_file, help="SQLite index file to read")
+    query.add_argument("--gene", default=None, help="MarkerID or Region (gene)")
+    query.add_argument("--trait", default=None, help="Trait (phenotype_ID)")
+    query.add_argument("--phecode", default=None, help="Original phecode")
+    query.add_argument("--ancestry", default=None, help="Ancestry")
+    query.add_argument("--max_p", type=float, default=None, help="Only rows with p.value (or Pvalue) below this")
+    query.add_argument("--output", default=None, help="Write results here instead of stdout")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_index(args.input, args.index, args.chunksize)
+    else:
+        if args.gene is None and args.trait is None and args.phecode is None:
+            print("Give at least one of --gene, --trait or --phecode.")
+            sys.exit(1)
+        df = query_index(args.index, args.gene, args.trait, args.phecode, args.ancestry, args.max_p)
+        df.to_csv(args.output or sys.stdout, sep="\t", index=False)
@@ -1,10 +1,137 @@
 import pandas as pd
+import argparse
+import heapq
+import itertools
 
-# Load the data
-df = pd.read_csv("combined_sorted_results.txt", sep="\t")
+from combine_and_sort_results import union_columns
+from reader_pool import filter_results
+from result_store import list_result_files, parse_filename, open_store, read_store, combine_filter, threshold_filter
+from step2_schema import read_step2, apply_dtypes, concat_frames, projections, with_log10p, below_threshold, p_value_columns
 
-# Filter rows where p.value < 1e-7
-df_filtered = df[df["p.value"] < 1e-7]
+input_file = "combined_sorted_results.txt"
+output_file = "hits.tsv"
 
-# Save to hits.tsv
-df_filtered.to_csv("hits.tsv", sep="\t", index=False)
+
+class TopK:
+    # Bounded min-heaps on -log10(p) keeping the k smallest p-values per group
+
+    def __init__(self, k, columns, group_by):
+        self.k = k
+        self.columns = columns
+        self.group_index = [columns.index(col) for col in group_by]
+        self.key_index = columns.index("LOG10P")
+        self.heaps = {}
+        self.counter = itertools.count()
+
+    def push(self, df):
+        for row in df[self.columns].itertuples(index=False, name=None):
+            heap = self.heaps.setdefault(tuple(row[i] for i in self.group_index), [])
+            item = (row[self.key_index], next(self.counter), row)
+            if len(heap) < self.k:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def result(self):
+        rows = [item[2] for heap in self.heaps.values() for item in heap]
+        return pd.DataFrame(rows, columns=self.columns)
+
+
+def select_hits(df, threshold, top_k, group_by):
+    # Vectorized pre-filter so only candidate rows reach the heaps
+    df = df[below_threshold(df, threshold)]
+    if top_k:
+        df = df.sort_values(by="LOG10P", ascending=False).groupby(group_by, sort=False).head(top_k)
+    return df
+
+
+def raw_chunks(files, columns, chunksize):
+    # Stream the step2 files with the combine filters, reading only the needed columns
+    needed = list(columns) + projections["filter"] + ["LOG10P"]
+    for file in files:
+        parsed = parse_filename(file)
+        if parsed is None:
+            continue
+        for chunk in read_step2(file, columns=needed, chunksize=chunksize):
+            yield filter_results(chunk, *parsed)
+
+
+def combined_chunks(path, columns, chunksize):
+    # Stream the combined file, reading only the needed columns
+    for chunk in read_step2(path, columns=columns, chunksize=chunksize):
+        yield chunk
+
+
+def extract_hits(chunks, columns, threshold, top_k=None, group_by=("Trait", "Ancestry")):
+    group_by = list(group_by)
+    heaps = TopK(top_k, columns, group_by) if top_k else None
+    hits = []
+
+    for chunk in chunks:
+        chunk = select_hits(chunk, threshold, top_k, group_by).reindex(columns=columns)
+        if chunk.empty:
+            continue
+        if heaps is not None:
+            heaps.push(chunk)
+        else:
+            hits.append(chunk)
+
+    if heaps is not None:
+        df = heaps.result()
+    elif hits:
+        df = concat_frames(hits)
+    else:
+        df = pd.DataFrame(columns=columns)
+
+    # Columns missing from some layouts (e.g. group-test columns in single-variant runs) were
+    # filled as float64 by reindex; restore the registry dtypes
+    return apply_dtypes(df).sort_values(by="LOG10P", ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract rows with p.value below a threshold, optionally the top k per group")
+    parser.add_argument("--input", default=input_file, help="Combined results file to read")
+    parser.add_argument("--raw", action="store_true",
+                        help="Read the step2 files directly (with the combine filters) instead of the combined file")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of combined_sorted_results.txt")
+    parser.add_argument("--threshold", type=float, default=1e-7, help="Keep rows with p.value below this")
+    parser.add_argument("--top_k", type=int, default=None, help="Keep at most this many hits per group")
+    parser.add_argument("--group_by", default="Trait,Ancestry",
+                        help="Comma-separated grouping columns for --top_k (e.g. add Group,max_MAF for group tests)")
+    parser.add_argument("--columns", default=None, help="Comma-separated output columns (default: all)")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows read per chunk")
+    parser.add_argument("--output", default=output_file, help="Output file")
+    args = parser.parse_args()
+
+    group_by = args.group_by.split(",")
+    files = list_result_files() if args.raw else []
+
+    if args.columns:
+        columns = args.columns.split(",")
+    elif args.raw:
+        columns = union_columns([f for f in files if parse_filename(f) is not None])
+    elif args.parquet:
+        columns = open_store(args.parquet).schema.names
+    else:
+        columns = with_log10p(pd.read_csv(args.input, sep="\t", nrows=0).columns)
+
+    # LOG10P and the grouping columns are always needed
+    for col in ["LOG10P"] + (group_by if args.top_k else []):
+        if col not in columns:
+            columns.append(col)
+
+    if args.parquet:
+        # Apply the combine filters and the p.value threshold in the Parquet scan
+        store = open_store(args.parquet)
+        p_filter = combine_filter(store) & threshold_filter(store.schema, args.threshold)
+        chunks = [read_store(args.parquet, columns=columns + [col for col in p_value_columns if col not in columns], filter=p_filter)]
+    elif args.raw:
+        chunks = raw_chunks(files, columns, args.chunksize)
+    else:
+        chunks = combined_chunks(args.input, columns, args.chunksize)
+
+    df_filtered = extract_hits(chunks, columns, args.threshold, args.top_k, group_by)
+
+    # Save to hits.tsv
+    df_filtered.to_csv(args.output, sep="\t", index=False)
+    print(f"{len(df_filtered)} hits saved to {args.output}")
@@ -0,0 +1,134 @@
+import pandas as pd
+import numpy as np
+import argparse
+import glob
+from functools import partial
+
+from qq_plot import lambda_from_median
+from reader_pool import map_files
+from result_store import file_pattern, parse_filename
+from step2_schema import read_step2, projections
+
+output_file = "lambda_gc_report.tsv"
+
+
+class Log10PSketch:
+    # Fixed-width histogram of -log10(p): constant memory per run, and two sketches merge by adding
+    # counts. Quantiles are exact to within half a bin (0.0005 in -log10 p, ~0.1% in p).
+
+    def __init__(self, width=0.001, max_log10p=30.0):
+        self.width = width
+        self.counts = np.zeros(int(round(max_log10p / width)) + 1, dtype=np.int64)
+
+    def add(self, log10p):
+        log10p = np.asarray(log10p, dtype=float)
+        log10p = log10p[~np.isnan(log10p)]
+        # Values past max_log10p (including inf from p = 0) share the last bin; they are far
+        # above any median of interest. Capping before the cast keeps inf out of bin 0.
+        log10p = np.clip(log10p, 0, (len(self.counts) - 1) * self.width)
+        bins = np.minimum((log10p / self.width).astype(np.int64), len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        # Interpolate linearly inside the bin holding the q-th value
+        if self.n == 0:
+            return np.nan
+        rank = q * self.n
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, rank))
+        before = cumulative[i - 1] if i > 0 else 0
+        return (i + (rank - before) / self.counts[i]) * self.width
+
+
+def sketch_file(file, chunksize=1000000):
+    # Stream one step2 file (AF_Allele2 < 0.5, as qq_plot.py) into a sketch
+    sketch = Log10PSketch()
+    for chunk in read_step2(file, columns=projections["qq"], chunksize=chunksize):
+        if "AF_Allele2" in chunk.columns:
+            chunk = chunk[chunk["AF_Allele2"] < 0.5]
+        sketch.add(chunk["LOG10P"])
+    return sketch
+
+
+def lambda_row(labels, sketch, max_lambda, min_lambda, min_tests):
+    median_log10p = sketch.quantile(0.5)
+    gc = lambda_from_median(median_log10p)
+
+    flags = []
+    if sketch.n < min_tests:
+        flags.append("few_tests")
+    if gc > max_lambda:
+        flags.append("inflated")
+    if gc < min_lambda:
+        flags.append("deflated")
+
+    return {
+        **labels,
+        "n_tests": sketch.n,
+        "median_log10p": median_log10p,
+        "lambda_gc": gc,
+        "flag": ",".join(flags),
+    }
+
+
+def lambda_report(files, processes=None, chunksize=1000000, max_lambda=1.1, min_lambda=0.9, min_tests=100):
+    files = [f for f in files if parse_filename(f) is not None]
+    sketches = map_files(partial(sketch_file, chunksize=chunksize), files, processes)
+
+    rows = []
+    pooled = {}
+    for file, sketch in zip(files, sketches):
+        ancestry, trait, variant_class = parse_filename(file)
+        labels = {"Ancestry": ancestry, "Trait": trait, "VariantClass": variant_class}
+        rows.append(lambda_row(labels, sketch, max_lambda, min_lambda, min_tests))
+
+        # Runs of the same ancestry and variant class are pooled by merging their sketches
+        key = (ancestry, variant_class)
+        if key in pooled:
+            pooled[key].merge(sketch)
+        else:
+            pooled[key] = sketch
+
+    columns = ["Ancestry", "Trait", "VariantClass", "n_tests", "median_log10p", "lambda_gc", "flag"]
+    report = pd.DataFrame(rows, columns=columns).sort_values(by="lambda_gc", ascending=False)
+
+    pooled_rows = [
+        lambda_row({"Ancestry": ancestry, "Trait": "ALL", "VariantClass": variant_class}, sketch,
+                   max_lambda, min_lambda, min_tests)
+        for (ancestry, variant_class), sketch in pooled.items()
+    ]
+    pooled_report = pd.DataFrame(pooled_rows, columns=columns).sort_values(by="lambda_gc", ascending=False)
+    return report, pooled_report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genomic-control lambda for every SAIGE step2 run, read in one streaming pass")
+    parser.add_argument("files", nargs="*", help="Step2 files (default: all matching the step2 file pattern)")
+    parser.add_argument("--max_lambda", type=float, default=1.1, help="Flag runs with lambda GC above this as inflated")
+    parser.add_argument("--min_lambda", type=float, default=0.9, help="Flag runs with lambda GC below this as deflated")
+    parser.add_argument("--min_tests", type=int, default=100, help="Flag runs with fewer tests than this")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes (default: all cores, 1 reads sequentially)")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows read per chunk")
+    parser.add_argument("--output", default=output_file, help="Per-run lambda GC table")
+    parser.add_argument("--pooled_output", default=None,
+                        help="Also write lambda GC pooled over traits per ancestry and variant class")
+    args = parser.parse_args()
+
+    files = args.files or glob.glob(file_pattern)
+    report, pooled_report = lambda_report(
+        files, args.processes, args.chunksize, args.max_lambda, args.min_lambda, args.min_tests
+    )
+
+    report.to_csv(args.output, sep="\t", index=False)
+    print(f"Lambda GC for {len(report)} runs saved to {args.output} ({(report['flag'] != '').sum()} flagged)")
+    if args.pooled_output:
+        pooled_report.to_csv(args.pooled_output, sep="\t", index=False)
+        print(f"Pooled lambda GC saved to {args.pooled_output}")
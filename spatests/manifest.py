@@ -0,0 +1,70 @@
+import pandas as pd
+import hashlib
+import os
+
+# Columns persisted for every input file
+manifest_columns = ["path", "size", "mtime", "sha256", "rows"]
+
+
+def manifest_path(output_file):
+    # Manifest lives next to the output it describes
+    base = output_file[:-3] if output_file.endswith(".gz") else output_file
+    return os.path.splitext(base)[0] + ".manifest.tsv"
+
+
+def fingerprint(path, chunk_size=1 << 20):
+    # Hash the file and count its data rows (excluding the header) in one read
+    sha = hashlib.sha256()
+    newlines = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+            newlines += chunk.count(b"\n")
+            last = chunk[-1:]
+    lines = newlines + (last != b"\n")
+    return sha.hexdigest(), max(lines - 1, 0)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path, sep="\t", dtype={"path": str, "sha256": str})
+    return {row["path"]: row for row in df.to_dict("records")}
+
+
+def write_manifest(entries, path):
+    df = pd.DataFrame(sorted(entries.values(), key=lambda e: e["path"]), columns=manifest_columns)
+    df.to_csv(path, sep="\t", index=False)
+
+
+def scan_files(files, previous=None):
+    # Return current entries and the paths that are new or changed since `previous`
+    previous = previous or {}
+    entries = {}
+    changed = []
+
+    for path in files:
+        stat = os.stat(path)
+        old = previous.get(path)
+
+        # Size and mtime unchanged: trust the recorded hash without rereading the file
+        if old is not None and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            entries[path] = old
+            continue
+
+        sha, rows = fingerprint(path)
+        entries[path] = {
+            "path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha, "rows": rows,
+        }
+        if old is None or old["sha256"] != sha:
+            changed.append(path)
+
+    return entries, changed
+
+
+def removed_files(entries, previous):
+    return [path for path in (previous or {}) if path not in entries]
@@ -0,0 +1,188 @@
+import pandas as pd
+import numpy as np
+import argparse
+import math
+
+from result_store import open_store, read_store, combine_filter
+from step2_schema import read_step2
+
+input_file = "combined_sorted_results.txt"
+output_file = "meta_analysis_results.tsv"
+
+# Each (gene, trait, variant class) is meta-analysed across the ancestries it was tested in
+group_columns = ["MarkerID", "Trait", "VariantClass"]
+input_columns = group_columns + ["Ancestry", "BETA", "SE", "LOG10P", "N", "N_case", "N_ctrl"]
+
+# Per-row terms whose per-group sums give every meta-analysis statistic
+sum_columns = ["k", "w", "wb", "wbb", "sqrt_n_z", "n"]
+
+# Inverse normal CDF (Acklam's rational approximation, relative error ~1e-9)
+acklam_a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+            1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+acklam_b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+            6.680131188771972e+01, -1.328068155288572e+01, 1.0]
+acklam_c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+            -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+acklam_d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+            3.754408661907416e+00, 1.0]
+
+# log(erfc(x)) for x >= 0 (Chebyshev fit, fractional error < 1.2e-7), highest power first
+erfc_coefs = [0.17087277, -0.82215223, 1.48851587, -1.13520398, 0.27886807,
+              -0.18628806, 0.09678418, 0.37409196, 1.00002368, -1.26551223]
+
+
+def z_from_log10p(log10p):
+    # |Z| of a two-sided test from -log10(p), without forming p in the tail so it cannot underflow
+    log10p = np.asarray(log10p, dtype=float)
+    log_half_p = -log10p * np.log(10) - np.log(2)
+    z = np.full(log10p.shape, np.nan)
+
+    tail = log_half_p < np.log(0.02425)
+    q = np.sqrt(-2 * log_half_p[tail])
+    z[tail] = -np.polyval(acklam_c, q) / np.polyval(acklam_d, q)
+
+    central = ~tail & ~np.isnan(log10p)
+    q = np.exp(log_half_p[central]) - 0.5
+    r = q * q
+    z[central] = -np.polyval(acklam_a, r) * q / np.polyval(acklam_b, r)
+    return z
+
+
+def log_erfc(x):
+    t = 1 / (1 + 0.5 * x)
+    return np.log(t) - x * x + np.polyval(erfc_coefs, t)
+
+
+def log10p_from_z(z):
+    # Two-sided -log10(p) for a standard normal statistic, computed on the log scale
+    return -log_erfc(np.abs(z) / np.sqrt(2)) / np.log(10)
+
+
+def chi2_sf(x, df):
+    # Upper tail of a chi-squared distribution with a small integer number of degrees of freedom
+    p = np.full(len(x), np.nan)
+    for k in np.unique(df[df > 0]):
+        sel = df == k
+        h = x[sel] / 2
+        if k % 2 == 0:
+            p[sel] = np.exp(-h) * sum(h ** i / math.factorial(i) for i in range(k // 2))
+        else:
+            p[sel] = np.exp(log_erfc(np.sqrt(h))) + np.exp(-h) * sum(
+                h ** (i + 0.5) / math.gamma(i + 1.5) for i in range((k - 1) // 2)
+            )
+    return p
+
+
+def sample_size(df):
+    # Quantitative traits use N; binary traits use the effective sample size 4 / (1/N_case + 1/N_ctrl)
+    n = np.full(len(df), np.nan)
+    if "N" in df.columns:
+        n = df["N"].to_numpy(dtype=float, na_value=np.nan)
+    if "N_case" in df.columns and "N_ctrl" in df.columns:
+        n_case = df["N_case"].to_numpy(dtype=float, na_value=np.nan)
+        n_ctrl = df["N_ctrl"].to_numpy(dtype=float, na_value=np.nan)
+        binary = ~np.isnan(n_case) & ~np.isnan(n_ctrl)
+        n[binary] = 4 / (1 / n_case[binary] + 1 / n_ctrl[binary])
+    return n
+
+
+def group_sums(df):
+    # Per-row weights, then one bincount per statistic over the group codes
+    beta = df["BETA"].to_numpy(dtype=float, na_value=np.nan)
+    se = df["SE"].to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(beta) & (se > 0)
+    df = df[valid]
+    beta = beta[valid]
+    se = se[valid]
+
+    # Missing sample sizes or p-values leave a row out of the Stouffer sums only
+    n = np.nan_to_num(sample_size(df))
+    z = np.sign(beta) * z_from_log10p(df["LOG10P"].to_numpy(dtype=float, na_value=np.nan))
+    n[np.isnan(z)] = 0
+    w = 1 / se ** 2
+
+    terms = {
+        "k": np.ones(len(df)),
+        "w": w,
+        "wb": w * beta,
+        "wbb": w * beta * beta,
+        "sqrt_n_z": np.sqrt(n) * np.nan_to_num(z),
+        "n": n,
+    }
+
+    codes, groups = pd.MultiIndex.from_frame(df[group_columns]).factorize()
+    return pd.DataFrame(
+        {col: np.bincount(codes, weights=terms[col], minlength=len(groups)) for col in sum_columns},
+        index=groups,
+    )
+
+
+def meta_analyse(sums, min_ancestries=2):
+    sums = sums[sums["k"] >= min_ancestries]
+    k = sums["k"].to_numpy()
+    w = sums["w"].to_numpy()
+    wb = sums["wb"].to_numpy()
+    wbb = sums["wbb"].to_numpy()
+    n = sums["n"].to_numpy()
+
+    # Fixed-effect inverse-variance weighting
+    beta = wb / w
+    se = np.sqrt(1 / w)
+
+    # Stouffer's Z with sqrt(sample size) weights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = sums["sqrt_n_z"].to_numpy() / np.sqrt(n)
+
+    # Cochran's Q (sum of w * (beta_i - beta)^2, expanded into the summed terms) and I^2
+    q = np.clip(wbb - wb * wb / w, 0, None)
+    q_df = (k - 1).astype(int)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        i2 = np.where(q > 0, np.clip((q - q_df) / q, 0, None), 0.0)
+
+    result = sums.index.to_frame(index=False)
+    result["N_ancestries"] = q_df + 1
+    result["BETA_IVW"] = beta.astype(np.float32)
+    result["SE_IVW"] = se.astype(np.float32)
+    result["LOG10P_IVW"] = log10p_from_z(beta / se).astype(np.float32)
+    result["Z_Stouffer"] = z.astype(np.float32)
+    result["LOG10P_Stouffer"] = log10p_from_z(z).astype(np.float32)
+    result["N_total"] = n.round().astype(np.int64)
+    result["Q"] = q.astype(np.float32)
+    result["Q_df"] = q_df
+    result["Q_pvalue"] = chi2_sf(q, q_df)
+    result["I2"] = i2.astype(np.float32)
+    return result.sort_values(by="LOG10P_IVW", ascending=False)
+
+
+def run_meta_analysis(chunks, min_ancestries=2):
+    # Sums are additive, so each chunk is reduced on its own and the partial sums are added up
+    partials = [group_sums(chunk) for chunk in chunks]
+    partials = [partial for partial in partials if not partial.empty]
+    if not partials:
+        sums = pd.DataFrame(columns=sum_columns, index=pd.MultiIndex.from_arrays([[]] * 3, names=group_columns))
+    elif len(partials) == 1:
+        sums = partials[0]
+    else:
+        sums = pd.concat(partials).groupby(level=list(range(len(group_columns))), sort=False).sum()
+    sums.index.names = group_columns
+    return meta_analyse(sums.astype(float), min_ancestries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-ancestry meta-analysis (IVW and Stouffer) per gene, trait and variant class")
+    parser.add_argument("--input", default=input_file, help="Combined results file to read")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of combined_sorted_results.txt")
+    parser.add_argument("--min_ancestries", type=int, default=2, help="Only report groups tested in at least this many ancestries")
+    parser.add_argument("--chunksize", type=int, default=5000000, help="Rows read per chunk")
+    parser.add_argument("--output", default=output_file, help="Output file")
+    args = parser.parse_args()
+
+    if args.parquet:
+        # Apply the combine filters in the Parquet scan
+        chunks = [read_store(args.parquet, columns=input_columns, filter=combine_filter(open_store(args.parquet)))]
+    else:
+        chunks = read_step2(args.input, columns=input_columns, chunksize=args.chunksize)
+
+    result = run_meta_analysis(chunks, args.min_ancestries)
+    result.to_csv(args.output, sep="\t", index=False)
+    print(f"Meta-analysis of {len(result)} gene / trait / variant class groups saved to {args.output}")
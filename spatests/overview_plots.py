@@ -0,0 +1,145 @@
+import pandas as pd
+import numpy as np
+import argparse
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from step2_schema import read_step2
+
+input_file = "combined_sorted_results.txt"
+
+# Group-test rows carry the gene in Region instead of MarkerID
+gene_columns = ["MarkerID", "Region"]
+
+
+def result_chunks(path, ancestry=None, variant_class=None, gene=None, chunksize=1000000):
+    # Stream the combined file reading only what the plots need, one gene column per row
+    columns = gene_columns + ["Trait", "Ancestry", "VariantClass", "LOG10P"]
+    for chunk in read_step2(path, columns=columns, chunksize=chunksize):
+        genes = [chunk[col].astype(object) for col in gene_columns if col in chunk.columns]
+        chunk = chunk.assign(Gene=genes[0].fillna(genes[1]) if len(genes) == 2 else genes[0])
+        if ancestry is not None:
+            chunk = chunk[chunk["Ancestry"] == ancestry]
+        if variant_class is not None:
+            chunk = chunk[chunk["VariantClass"] == variant_class]
+        if gene is not None:
+            chunk = chunk[chunk["Gene"] == gene]
+        yield chunk[["Gene", "Trait", "LOG10P"]].dropna()
+
+
+def gene_trait_max(chunks):
+    # Strongest -log10(p) per gene and trait, reduced chunk by chunk
+    best = None
+    for chunk in chunks:
+        part = chunk.groupby(["Gene", "Trait"], observed=True)["LOG10P"].max()
+        best = part if best is None else pd.concat([best, part]).groupby(level=[0, 1]).max()
+    if best is None:
+        return pd.DataFrame()
+    return best.unstack("Trait")
+
+
+def trait_log10p_counts(chunks, bin_width, max_log10p, min_hit_log10p):
+    # Number of results per trait and -log10(p) bin (values above max_log10p share the top bin),
+    # plus the rows above min_hit_log10p, which are few enough to draw individually
+    n_bins = int(np.ceil(max_log10p / bin_width))
+    counts = None
+    hits = []
+    for chunk in chunks:
+        # Cap before the cast: inf (p = 0) would otherwise wrap to the lowest bin
+        log10p = np.clip(chunk["LOG10P"].to_numpy(dtype=float), 0, max_log10p)
+        bins = np.minimum((log10p / bin_width).astype(int), n_bins - 1)
+        part = chunk.groupby([chunk["Trait"].astype(str).to_numpy(), bins]).size()
+        counts = part if counts is None else counts.add(part, fill_value=0)
+        hits.append(chunk[chunk["LOG10P"] > min_hit_log10p])
+    if counts is None:
+        return pd.DataFrame(), n_bins, pd.DataFrame()
+    counts = counts.unstack(level=0).reindex(range(n_bins)).fillna(0)
+    return counts.sort_index(axis=1), n_bins, pd.concat(hits)
+
+
+def plot_heatmap(path, output_file, ancestry=None, variant_class=None, max_rows=2000,
+                 max_log10p=50.0, chunksize=1000000, dpi=300):
+    grid = gene_trait_max(result_chunks(path, ancestry, variant_class, chunksize=chunksize))
+    if grid.empty:
+        print("No results to plot.")
+        return
+    grid = grid.sort_index().sort_index(axis=1)
+
+    # More genes than pixel rows: each row shows the strongest signal of a block of genes
+    values = grid.to_numpy(dtype=np.float32)
+    genes = grid.index.to_numpy()
+    block = int(np.ceil(len(genes) / max_rows))
+    if block > 1:
+        pad = block * int(np.ceil(len(genes) / block)) - len(genes)
+        values = np.vstack([values, np.full((pad, values.shape[1]), np.nan, dtype=np.float32)])
+        with np.errstate(all="ignore"):
+            values = np.nanmax(values.reshape(-1, block, values.shape[1]), axis=1)
+        genes = genes[::block]
+
+    plt.figure(figsize=(max(6, 0.15 * len(grid.columns)), 10))
+    image = plt.imshow(np.clip(values, 0, max_log10p), aspect="auto", interpolation="nearest", cmap="viridis")
+    plt.colorbar(image, label=f"-log10(p) (capped at {max_log10p:g})")
+    plt.xticks(range(len(grid.columns)), grid.columns, rotation=90, fontsize=6)
+    if len(genes) <= 100:
+        plt.yticks(range(len(genes)), genes, fontsize=6)
+    else:
+        plt.ylabel(f"Genes ({len(grid)}, {block} per row)" if block > 1 else f"Genes ({len(grid)})")
+    plt.xlabel("Trait")
+    plt.title(" - ".join(["Gene x trait"] + [label for label in (ancestry, variant_class) if label]))
+    plt.tight_layout()
+    plt.savefig(output_file, dpi=dpi)
+    plt.close()
+    print(f"Saved heatmap: {output_file}")
+
+
+def plot_phewas(path, output_file, gene=None, ancestry=None, variant_class=None, threshold=1e-7,
+                bin_width=0.1, max_log10p=50.0, chunksize=1000000, dpi=300):
+    # Bulk of the results as a per-trait density image, results past the threshold as points
+    chunks = result_chunks(path, ancestry, variant_class, gene, chunksize=chunksize)
+    counts, n_bins, hits = trait_log10p_counts(chunks, bin_width, max_log10p, -np.log10(threshold))
+    if counts.empty:
+        print("No results to plot.")
+        return
+    traits = counts.columns
+
+    plt.figure(figsize=(max(8, 0.15 * len(traits)), 5))
+    density = np.log1p(counts.to_numpy())
+    plt.imshow(np.ma.masked_equal(density, 0), origin="lower", aspect="auto", interpolation="nearest",
+               cmap="Greys", extent=(-0.5, len(traits) - 0.5, 0, n_bins * bin_width))
+    x = pd.Index(traits).get_indexer(hits["Trait"].astype(str))
+    plt.scatter(x, np.minimum(hits["LOG10P"], max_log10p), s=8, color="red", zorder=3)
+    plt.axhline(-np.log10(threshold), color="red", linestyle="--", linewidth=0.8)
+    plt.xticks(range(len(traits)), traits, rotation=90, fontsize=6)
+    plt.xlabel("Trait")
+    plt.ylabel(f"-log10(p) (capped at {max_log10p:g})")
+    plt.title(" - ".join(["PheWAS"] + [label for label in (gene, ancestry, variant_class) if label]))
+    plt.tight_layout()
+    plt.savefig(output_file, dpi=dpi)
+    plt.close()
+    print(f"Saved PheWAS plot: {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Overview plots of the combined association results")
+    parser.add_argument("plot", choices=["heatmap", "phewas"], help="Gene x trait heatmap, or PheWAS across traits")
+    parser.add_argument("--input", default=input_file, help="Combined results file to read")
+    parser.add_argument("--gene", default=None, help="PheWAS for this gene only (default: all genes)")
+    parser.add_argument("--ancestry", default=None, help="Only results for this ancestry")
+    parser.add_argument("--variant_class", default=None, help="Only results for this variant class")
+    parser.add_argument("--threshold", type=float, default=1e-7, help="PheWAS: draw results with p.value below this as points")
+    parser.add_argument("--bin_width", type=float, default=0.1, help="PheWAS: -log10(p) bin height of the density image")
+    parser.add_argument("--max_rows", type=int, default=2000, help="Heatmap: maximum gene rows drawn")
+    parser.add_argument("--max_log10p", type=float, default=50.0, help="Cap -log10(p) at this value")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows read per chunk")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the saved plot")
+    parser.add_argument("--output", default=None, help="Output image (default: <plot>.png)")
+    args = parser.parse_args()
+
+    output_file = args.output or f"{args.plot}.png"
+    if args.plot == "heatmap":
+        plot_heatmap(args.input, output_file, args.ancestry, args.variant_class, args.max_rows,
+                     args.max_log10p, args.chunksize, args.dpi)
+    else:
+        plot_phewas(args.input, output_file, args.gene, args.ancestry, args.variant_class, args.threshold,
+                    args.bin_width, args.max_log10p, args.chunksize, args.dpi)
@@ -1,56 +1,151 @@
 import sys
+import argparse
+import glob
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from statistics import NormalDist
 
-def plot_qq(input_file):
+from result_store import file_pattern, read_store, partition_filter
+from step2_schema import read_step2, projections
+
+# Median of a 1-df chi-squared distribution
+chi2_median = 0.45493642311957283
+
+def lambda_from_median(median_log10p):
+    # Median chi-squared statistic (from the median -log10(p)) over its null expectation
+    if np.isnan(median_log10p):
+        return np.nan
+    median_p = min(max(10 ** -median_log10p, 1e-300), 1.0)
+    return NormalDist().inv_cdf(median_p / 2) ** 2 / chi2_median
+
+def lambda_gc(log10p):
+    # Genomic-control lambda from -log10(p)
+    log10p = np.asarray(log10p, dtype=float)
+    log10p = log10p[~np.isnan(log10p)]
+    if len(log10p) == 0:
+        return np.nan
+    return lambda_from_median(np.median(log10p))
+
+def thin_points(expected, observed, thin_below, resolution=0.01):
+    # Keep one point per grid cell where -log10(p) < thin_below; keep every tail point
+    dense = observed < thin_below
+    cells = np.round(np.column_stack([expected[dense], observed[dense]]) / resolution)
+    _, keep = np.unique(cells, axis=0, return_index=True)
+    keep = np.concatenate([np.flatnonzero(dense)[keep], np.flatnonzero(~dense)])
+    return expected[keep], observed[keep]
+
+def plot_qq(input_file, store=None, thin_below=None, dpi=300):
     # Extract ancestry, trait, and variant class from filename
     match = re.search(r'aou_snp_(.*?)_step2_(.*?)_vars_(.*?)\.txt', input_file)
     if not match:
         print(f"Filename format not recognized: {input_file}")
-        sys.exit(1)
+        return None
     
     ancestry, trait, variant_class = match.groups()
     output_file = f"qqplot_{ancestry}_{trait}_{variant_class}.png"
 
-    # Read the file
-    df = pd.read_csv(input_file, delim_whitespace=True)
-    # Filter out rows where AF_Allele2 > 0.5
-    df = df[df["AF_Allele2"] < 0.5]
+    # Read the file, or just this run's partition and columns from the Parquet store
+    if store:
+        df = read_store(
+            store,
+            columns=projections["qq"],
+            filter=partition_filter(ancestry, trait, variant_class),
+        )
+        # N_case is all null for quantitative runs once schemas are unified
+        if "N_case" in df.columns and df["N_case"].isna().all():
+            df = df.drop(columns="N_case")
+    else:
+        df = read_step2(input_file, columns=projections["qq"], sep=r"\s+")
+    # Filter out rows where AF_Allele2 > 0.5 (group tests have no AF_Allele2)
+    if "AF_Allele2" in df.columns:
+        df = df[df["AF_Allele2"] < 0.5]
 
-    # Extract p-values
-    p_values = df["p.value"].dropna()
+    # Extract -log10 p-values (already parsed without underflow)
+    log10p = df["LOG10P"].dropna().to_numpy(dtype=float)
 
     # Compute expected quantiles
-    n = len(p_values)
+    n = len(log10p)
     expected = -np.log10((np.arange(1, n + 1) / (n + 1)))
-    observed = -np.log10(np.sort(p_values))
+    observed = np.sort(log10p)[::-1]
+
+    # Genomic-control lambda on the full set of p-values, before any thinning
+    gc = lambda_gc(log10p)
 
     # Construct title
     title = f"QQ Plot: {ancestry} - {trait} - {variant_class}"
     
     # If N_case column exists, add to title
+    total_cases = np.nan
     if "N_case" in df.columns:
         total_cases = df["N_case"].median()  # 
         title += f" (N_cases: {total_cases})"
 
+    line = [expected[0], expected[-1]] if n else [0, 1]
+    if thin_below is not None:
+        expected, observed = thin_points(expected, observed, thin_below)
+
     # Generate QQ plot
     plt.figure(figsize=(6,6))
     plt.scatter(expected, observed, edgecolor='black', alpha=0.6)
-    plt.plot([expected[0], expected[-1]], [expected[0], expected[-1]], color="red", linestyle="--")
+    plt.plot(line, line, color="red", linestyle="--")
     plt.xlabel("Expected -log10(p)")
     plt.ylabel("Observed -log10(p)")
     plt.title(title)
     plt.grid(True)
 
     # Save plot
-    plt.savefig(output_file, dpi=300)
+    plt.savefig(output_file, dpi=dpi)
     plt.close()
     print(f"Saved QQ plot: {output_file}")
 
+    return {
+        "Ancestry": ancestry,
+        "Trait": trait,
+        "VariantClass": variant_class,
+        "n_tests": n,
+        "n_plotted": len(observed),
+        "N_case": total_cases,
+        "lambda_gc": gc,
+        "plot": output_file,
+    }
+
+def plot_batch(input_files, store=None, thin_below=2.0, dpi=300, processes=None, summary_file="qq_summary.tsv"):
+    # Render every run across a process pool and collect lambda GC per plot
+    plot = partial(plot_qq, store=store, thin_below=thin_below, dpi=dpi)
+    with ProcessPoolExecutor(processes) as pool:
+        rows = [row for row in pool.map(plot, input_files) if row is not None]
+
+    columns = ["Ancestry", "Trait", "VariantClass", "n_tests", "n_plotted", "N_case", "lambda_gc", "plot"]
+    summary = pd.DataFrame(rows, columns=columns).sort_values(by="lambda_gc", ascending=False)
+    summary.to_csv(summary_file, sep="\t", index=False)
+    print(f"Saved lambda GC summary for {len(summary)} plots: {summary_file}")
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python qq_plot.py <input_file>")
-        sys.exit(1)
-    plot_qq(sys.argv[1])
+    parser = argparse.ArgumentParser(description="QQ plots for SAIGE step2 result files")
+    parser.add_argument("input_files", nargs="*", help="Step2 result file(s) (also name the runs when reading from --parquet)")
+    parser.add_argument("--parquet", default=None, help="Read from a Parquet store built by result_store.py instead of the text file")
+    parser.add_argument("--batch", action="store_true",
+                        help="Plot all given files (default: every step2 file here) in parallel and write a lambda GC summary")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes for --batch (default: all cores)")
+    parser.add_argument("--thin_below", type=float, default=None,
+                        help="Bin points with -log10(p) below this value; tail points are always kept (--batch default: 2)")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the saved plots")
+    parser.add_argument("--summary", default="qq_summary.tsv", help="Lambda GC summary table for --batch")
+    args = parser.parse_args()
+
+    if args.batch:
+        input_files = args.input_files or glob.glob(file_pattern)
+        thin_below = 2.0 if args.thin_below is None else args.thin_below
+        plot_batch(input_files, args.parquet, thin_below, args.dpi, args.processes, args.summary)
+    else:
+        if len(args.input_files) != 1:
+            print("Usage: python qq_plot.py <input_file>")
+            sys.exit(1)
+        if plot_qq(args.input_files[0], args.parquet, args.thin_below, args.dpi) is None:
+            sys.exit(1)
@@ -0,0 +1,80 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from result_store import parse_filename
+from step2_schema import read_step2, apply_dtypes, projections
+
+# Metadata columns added from the filename
+meta_columns = ["Ancestry", "Trait", "VariantClass"]
+
+
+def filter_results(df, ancestry, trait, variant_class):
+    # Add extracted metadata as new columns
+    df["Ancestry"] = ancestry
+    df["Trait"] = trait
+    df["VariantClass"] = variant_class
+    df = apply_dtypes(df)
+
+    # Apply filtering if columns exist (missing counts never pass)
+    if "AC_Allele2" in df.columns:
+        df = df[df["AC_Allele2"] >= 10]
+    elif "MAC" in df.columns:
+        # Group tests: minor allele count of the collapsed gene / mask / max_MAF unit
+        # (Cauchy-combined rows carry no MAC of their own and are kept)
+        df = df[(df["MAC"] >= 10) | df["MAC"].isna()]
+
+    if "N_case" in df.columns:
+        df = df[(df["N_case"] >= 100).fillna(False)]
+
+    if "AF_Allele2" in df.columns:
+        df = df[df["AF_Allele2"] < 0.5]  # Keep only if AF_Allele2 < 0.5
+
+    return df
+
+
+def read_filtered(file, columns=None):
+    # Parse and filter one step2 file; only the surviving rows are returned
+    parsed = parse_filename(file)
+    if parsed is None:
+        return None
+    if columns is not None:
+        columns = list(columns) + projections["filter"]
+    return filter_results(read_step2(file, columns=columns), *parsed)
+
+
+def iter_filtered(file, chunksize, columns=None):
+    # Same rows as read_filtered, one chunk of at most chunksize rows at a time
+    parsed = parse_filename(file)
+    if parsed is None:
+        return
+    if columns is not None:
+        columns = list(columns) + projections["filter"]
+    for chunk in read_step2(file, columns=columns, chunksize=chunksize):
+        yield filter_results(chunk, *parsed)
+
+
+def read_high_af(file, min_af=0.5):
+    # Genes with AF_Allele2 >= min_af in one step2 file, or None if the columns are missing
+    df = read_step2(file, columns=projections["high_af"])
+    if "MarkerID" not in df.columns or "AF_Allele2" not in df.columns:
+        return None
+    return df.loc[df["AF_Allele2"] >= min_af, "MarkerID"].unique().tolist()
+
+
+def map_files(worker, files, processes=None):
+    # Run worker over the files in a process pool, yielding results in file order. At most
+    # two files per process are in flight, so parsed results never pile up in the parent.
+    processes = processes or os.cpu_count()
+    if processes <= 1:
+        yield from map(worker, files)
+        return
+
+    with ProcessPoolExecutor(processes) as pool:
+        pending = deque()
+        for file in files:
+            pending.append(pool.submit(worker, file))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,177 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+from step2_schema import step2_dtypes, arrow_types, p_value_columns, read_step2, apply_dtypes
+
+# Step2 text outputs and the partitioned Parquet store they are ingested into
+file_pattern = "aou_snp_*_step2_*_vars_*.txt"
+store_dir = "step2_parquet"
+
+# Partition columns, in the same order they are extracted from the filename
+partition_columns = ["Ancestry", "Trait", "VariantClass"]
+
+# Partition values are always strings (e.g. a trait of "250.2" must not become a float)
+partitioning = ds.partitioning(
+    pa.schema([(col, pa.string()) for col in partition_columns]), flavor="hive"
+)
+
+
+def list_result_files(exclude_additive=True):
+    files = glob.glob(file_pattern)
+    if exclude_additive:
+        files = [f for f in files if "ADDITIVE" not in f]
+    return files
+
+
+def parse_filename(file):
+    # Extract ancestry, trait, and variant class from filename
+    match = re.search(r'aou_snp_(.*?)_step2_(.*?)_vars_(.*?)\.txt', file)
+    if not match:
+        return None
+    return match.groups()
+
+
+def to_arrow(df):
+    # Registry dtypes map to fixed Arrow types so every file in the store unifies
+    fields = []
+    for col in df.columns:
+        dtype = step2_dtypes.get(col)
+        if dtype is None:
+            fields.append(pa.Schema.from_pandas(df[[col]], preserve_index=False).field(col))
+        else:
+            fields.append(pa.field(col, arrow_types[dtype]))
+
+    return pa.Table.from_pandas(df, preserve_index=False).cast(pa.schema(fields))
+
+
+def partition_path(root, ancestry, trait, variant_class):
+    return os.path.join(
+        root, f"Ancestry={ancestry}", f"Trait={trait}", f"VariantClass={variant_class}"
+    )
+
+
+def ingest_file(file, root=store_dir, row_group_size=100000):
+    parsed = parse_filename(file)
+    if parsed is None:
+        return None
+
+    table = to_arrow(read_step2(file))
+
+    # One file per partition, so re-ingesting a rerun replaces the old results
+    out_dir = partition_path(root, *parsed)
+    os.makedirs(out_dir, exist_ok=True)
+    out_file = os.path.join(out_dir, "part-0.parquet")
+    pq.write_table(
+        table, out_file, row_group_size=row_group_size, compression="zstd", write_statistics=True
+    )
+    return out_file
+
+
+def open_store(root=store_dir):
+    dataset = ds.dataset(root, format="parquet", partitioning=partitioning)
+
+    # Binary and quantitative runs have different columns, so unify across all files
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if not schemas:
+        return dataset
+    unified = pa.unify_schemas(schemas + [partitioning.schema])
+    return ds.dataset(root, format="parquet", partitioning=partitioning, schema=unified)
+
+
+def read_store(root=store_dir, columns=None, filter=None):
+    dataset = open_store(root)
+    if columns is not None:
+        columns = [col for col in columns if col in dataset.schema.names]
+    return apply_dtypes(dataset.to_table(columns=columns, filter=filter).to_pandas())
+
+
+def partition_filter(ancestry=None, trait=None, variant_class=None):
+    expr = None
+    for col, value in zip(partition_columns, (ancestry, trait, variant_class)):
+        if value is None:
+            continue
+        cond = ds.field(col) == value
+        expr = cond if expr is None else expr & cond
+    return expr
+
+
+def run_filter(fragments):
+    # Expression matching the rows of the given runs (one store fragment per run)
+    expr = None
+    for fragment in fragments:
+        keys = dict(part.split("=", 1) for part in fragment.path.split("/") if "=" in part)
+        cond = partition_filter(*(keys.get(col) for col in partition_columns))
+        expr = cond if expr is None else expr | cond
+    return expr
+
+
+def combine_filter(dataset):
+    # Same filters combine_and_sort_results.py applies to the text files, ADDITIVE runs excluded
+    schema = dataset.schema
+    single = None
+    if "AC_Allele2" in schema.names:
+        single = ds.field("AC_Allele2") >= 10
+        if "N_case" in schema.names:
+            # Runs without an N_case column (quantitative traits) are exempt; a missing
+            # N_case in a binary run fails the filter, as in the text path
+            n_case = ds.field("N_case") >= 100
+            no_n_case = run_filter(
+                f for f in dataset.get_fragments() if "N_case" not in f.physical_schema.names
+            )
+            single = single & (n_case if no_n_case is None else n_case | no_n_case)
+        if "AF_Allele2" in schema.names:
+            single = single & (ds.field("AF_Allele2") < 0.5)
+
+    group = None
+    if "MAC" in schema.names:
+        group = ds.field("MAC").is_null() | (ds.field("MAC") >= 10)
+
+    if single is not None and group is not None:
+        # Store holds both layouts: filter each row by the rules of its own layout
+        expr = (ds.field("Region").is_null() & single) | (ds.field("Region").is_valid() & group)
+    else:
+        expr = single if single is not None else group
+
+    for col in partition_columns:
+        expr = expr & ~pc.match_substring(ds.field(col), "ADDITIVE")
+    return expr
+
+
+def threshold_filter(schema, threshold):
+    # p < threshold on the float64 p-value where it is a normal float, LOG10P where it underflowed
+    tiny = np.finfo(np.float64).tiny
+    expr = ds.field("LOG10P") > -np.log10(threshold)
+    for col in p_value_columns:
+        if col in schema.names:
+            normal = ds.field(col) >= tiny
+            expr = (normal & (ds.field(col) < threshold)) | (
+                (ds.field(col).is_null() | (ds.field(col) < tiny)) & expr
+            )
+    return expr
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest SAIGE step2 text outputs into a partitioned Parquet store")
+    parser.add_argument("files", nargs="*", help="Step2 files to ingest (default: all matching the step2 file pattern)")
+    parser.add_argument("--store", default=store_dir, help="Parquet store directory")
+    parser.add_argument("--row_group_size", type=int, default=100000, help="Rows per Parquet row group")
+    args = parser.parse_args()
+
+    files = args.files or list_result_files(exclude_additive=False)
+
+    ingested = 0
+    for file in files:
+        if ingest_file(file, args.store, args.row_group_size) is None:
+            print(f"Skipping {file}: Filename format not recognized.")
+            continue
+        ingested += 1
+
+    print(f"Ingested {ingested} files into '{args.store}'.")
@@ -0,0 +1,182 @@
+import pandas as pd
+import numpy as np
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+
+from combine_and_sort_results import union_columns, flush_run, reduce_runs, run_reader, merge_readers
+from qq_plot import lambda_gc
+from reader_pool import filter_results
+from result_store import file_pattern, parse_filename
+from step2_schema import read_step2, concat_frames, below_threshold
+
+
+class CombinedSink:
+    # Filtered rows of every non-ADDITIVE file, merged into one file sorted by p.value
+
+    def __init__(self, files, output_file="combined_sorted_results.txt", buffer_rows=1000000, tmp_dir=None, max_open_runs=256):
+        self.columns = union_columns([f for f in files if "ADDITIVE" not in f])
+        self.output_file = output_file
+        self.buffer_rows = buffer_rows
+        self.max_open_runs = max_open_runs
+        self.run_dir = tempfile.mkdtemp(prefix="scan_runs_", dir=tmp_dir)
+        self.runs = []
+        self.buffer = []
+        self.buffered = 0
+
+    def consume(self, file, chunk, ancestry, trait, variant_class):
+        if "ADDITIVE" in file:
+            return
+        chunk = filter_results(chunk.copy(), ancestry, trait, variant_class)
+        if chunk.empty:
+            return
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= self.buffer_rows:
+            flush_run(self.buffer, self.columns, self.run_dir, self.runs)
+            self.buffer = []
+            self.buffered = 0
+
+    def end_file(self, file, ancestry, trait, variant_class):
+        pass
+
+    def finish(self):
+        try:
+            if self.buffer:
+                flush_run(self.buffer, self.columns, self.run_dir, self.runs)
+            key_index = self.columns.index("LOG10P")
+            runs = reduce_runs(self.runs, key_index, self.run_dir, self.max_open_runs)
+            with open(self.output_file, "w") as out:
+                out.write("\t".join(self.columns) + "\n")
+                merge_readers([run_reader(run, key_index) for run in runs], out)
+        finally:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+        print(f"Combined results saved as '{self.output_file}'.")
+
+
+class HighAFSink:
+    # Unique gene + ancestry + variant class with AF_Allele2 >= 0.5 (all files, as extract_high_AF_combos.py)
+
+    def __init__(self, files, output_file="high_AF_combos.txt"):
+        self.output_file = output_file
+        self.unique_combos = set()
+
+    def consume(self, file, chunk, ancestry, trait, variant_class):
+        if "MarkerID" not in chunk.columns or "AF_Allele2" not in chunk.columns:
+            return
+        genes = chunk.loc[chunk["AF_Allele2"] >= 0.5, "MarkerID"].unique()
+        self.unique_combos.update((gene, ancestry, variant_class) for gene in genes)
+
+    def end_file(self, file, ancestry, trait, variant_class):
+        pass
+
+    def finish(self):
+        output_df = pd.DataFrame(self.unique_combos, columns=["Gene", "Ancestry", "VariantClass"])
+        output_df.to_csv(self.output_file, sep="\t", index=False)
+        print(f"High AF combos saved in '{self.output_file}'.")
+
+
+class HitsSink:
+    # Filtered rows with p.value below the threshold (as get_hits.py on the combined file)
+
+    def __init__(self, files, output_file="hits.tsv", threshold=1e-7):
+        self.output_file = output_file
+        self.threshold = threshold
+        self.hits = []
+
+    def consume(self, file, chunk, ancestry, trait, variant_class):
+        if "ADDITIVE" in file:
+            return
+        chunk = filter_results(chunk.copy(), ancestry, trait, variant_class)
+        hits = chunk[below_threshold(chunk, self.threshold)]
+        if not hits.empty:
+            self.hits.append(hits)
+
+    def end_file(self, file, ancestry, trait, variant_class):
+        pass
+
+    def finish(self):
+        if self.hits:
+            df = concat_frames(self.hits).sort_values(by="LOG10P", ascending=False)
+        else:
+            df = pd.DataFrame()
+        df.to_csv(self.output_file, sep="\t", index=False)
+        print(f"{len(df)} hits saved in '{self.output_file}'.")
+
+
+class QQSink:
+    # Per-file sorted -log10(p) (AF_Allele2 < 0.5, as qq_plot.py) and a genomic-control lambda table
+
+    def __init__(self, files, output_dir="qq_inputs", summary_file="qq_lambda.tsv"):
+        self.output_dir = output_dir
+        self.summary_file = summary_file
+        self.log10p = []
+        self.n_cases = []
+        self.rows = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def consume(self, file, chunk, ancestry, trait, variant_class):
+        if "AF_Allele2" in chunk.columns:
+            chunk = chunk[chunk["AF_Allele2"] < 0.5]
+        self.log10p.append(chunk["LOG10P"].dropna().to_numpy())
+        if "N_case" in chunk.columns:
+            self.n_cases.append(chunk["N_case"].to_numpy(dtype=float, na_value=np.nan))
+
+    def end_file(self, file, ancestry, trait, variant_class):
+        log10p = np.sort(np.concatenate(self.log10p))[::-1] if self.log10p else np.array([], dtype=np.float32)
+        n_case = np.nanmedian(np.concatenate(self.n_cases)) if self.n_cases else np.nan
+        self.log10p = []
+        self.n_cases = []
+
+        np.save(os.path.join(self.output_dir, f"qq_{ancestry}_{trait}_{variant_class}.npy"), log10p)
+        self.rows.append({
+            "Ancestry": ancestry,
+            "Trait": trait,
+            "VariantClass": variant_class,
+            "n_tests": len(log10p),
+            "N_case": n_case,
+            "lambda_gc": lambda_gc(log10p),
+        })
+
+    def finish(self):
+        columns = ["Ancestry", "Trait", "VariantClass", "n_tests", "N_case", "lambda_gc"]
+        pd.DataFrame(self.rows, columns=columns).to_csv(self.summary_file, sep="\t", index=False)
+        print(f"QQ inputs saved in '{self.output_dir}', lambda GC table in '{self.summary_file}'.")
+
+
+# Available sinks, selected by name on the command line
+sinks = {
+    "combined": CombinedSink,
+    "high_af": HighAFSink,
+    "hits": HitsSink,
+    "qq": QQSink,
+}
+
+
+def scan(files, active, chunksize=1000000):
+    # Read each file exactly once and fan every chunk out to all active sinks
+    for file in files:
+        parsed = parse_filename(file)
+        if parsed is None:
+            continue
+        for chunk in read_step2(file, chunksize=chunksize):
+            for sink in active:
+                sink.consume(file, chunk, *parsed)
+        for sink in active:
+            sink.end_file(file, *parsed)
+
+    for sink in active:
+        sink.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single pass over SAIGE step2 results feeding several outputs")
+    parser.add_argument("--sinks", default=",".join(sinks), help=f"Comma-separated outputs to produce: {', '.join(sinks)}")
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Rows read per chunk")
+    args = parser.parse_args()
+
+    files = glob.glob(file_pattern)
+    active = [sinks[name](files) for name in args.sinks.split(",")]
+    scan(files, active, args.chunksize)
@@ -0,0 +1,184 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+
+# Compact pandas dtypes for SAIGE step2 outputs. p-values stay float64 because
+# float32 underflows below ~1e-38; effect sizes, frequencies and variances do not
+# need double precision, counts fit in 32 bits and labels repeat across runs.
+# Sorting, thresholds, QQ plots and storage use LOG10P (-log10 p) instead, parsed
+# straight from the text so p-values below the float64 range keep their magnitude.
+
+# Single-variant tests (binary traits add AF_case/AF_ctrl and case/control counts, quantitative traits add N)
+single_variant_dtypes = {
+    "CHR": "category",
+    "POS": "Int32",
+    "MarkerID": "category",
+    "Allele1": "category",
+    "Allele2": "category",
+    "AC_Allele2": "float32",
+    "AF_Allele2": "float32",
+    "MissingRate": "float32",
+    "BETA": "float32",
+    "SE": "float32",
+    "Tstat": "float32",
+    "var": "float32",
+    "p.value": "float64",
+    "p.value.NA": "float64",
+    "LOG10P": "float32",
+    "Is.SPA": "boolean",
+    "AF_case": "float32",
+    "AF_ctrl": "float32",
+    "N_case": "Int32",
+    "N_ctrl": "Int32",
+    "N_case_hom": "Int32",
+    "N_case_het": "Int32",
+    "N_ctrl_hom": "Int32",
+    "N_ctrl_het": "Int32",
+    "N": "Int32",
+}
+
+# Group tests (burden / SKAT / SKAT-O per gene, annotation mask and max_MAF cutoff)
+group_test_dtypes = {
+    "Region": "category",
+    "Group": "category",
+    "max_MAF": "float32",
+    "Pvalue": "float64",
+    "Pvalue_Burden": "float64",
+    "Pvalue_SKAT": "float64",
+    "BETA_Burden": "float32",
+    "SE_Burden": "float32",
+    "MAC": "float32",
+    "MAC_case": "float32",
+    "MAC_control": "float32",
+    "Number_rare": "Int32",
+    "Number_ultra_rare": "Int32",
+}
+
+# Labels added from the result filename
+label_dtypes = {
+    "Ancestry": "category",
+    "Trait": "category",
+    "VariantClass": "category",
+}
+
+step2_dtypes = {**single_variant_dtypes, **group_test_dtypes, **label_dtypes}
+
+# p-value column of each layout (single-variant, group test); LOG10P is derived from it
+p_value_columns = ["p.value", "Pvalue"]
+
+# Column projections used by the spatests readers (None reads every column)
+projections = {
+    "combine": None,
+    "filter": ["AC_Allele2", "N_case", "AF_Allele2", "MAC"],
+    "high_af": ["MarkerID", "AF_Allele2"],
+    "hits": None,
+    "qq": ["p.value", "LOG10P", "AF_Allele2", "N_case"],
+}
+
+# Arrow equivalents of the pandas dtypes, for the Parquet store
+arrow_types = {
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "string": pa.string(),
+    "boolean": pa.bool_(),
+    "float32": pa.float32(),
+    "float64": pa.float64(),
+    "Int32": pa.int32(),
+    "Int64": pa.int64(),
+}
+
+
+def is_group_test(columns):
+    # Group-test outputs have one row per gene (Region), annotation mask (Group) and max_MAF
+    return "Region" in columns
+
+
+def usecols(columns):
+    # Tolerate columns missing from a given layout (e.g. N_case in quantitative runs)
+    if columns is None:
+        return None
+    wanted = set(columns)
+    return lambda col: col in wanted
+
+
+def log10p_from_text(text, p):
+    # -log10(p) from the p-value text; p is its float64 parse, used where in range
+    with np.errstate(divide="ignore"):
+        log10p = -np.log10(p.to_numpy(dtype=float, na_value=np.nan))
+
+    # Zero or subnormal after parsing: rebuild from mantissa and exponent (e.g. "2.5e-400")
+    tiny = (p < np.finfo(np.float64).tiny).fillna(False).to_numpy()
+    if tiny.any():
+        parts = text[tiny].astype(str).str.extract(r"^\s*([0-9.]+)[eE]([+-]?\d+)\s*$")
+        mantissa = pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float)
+        exponent = pd.to_numeric(parts[1], errors="coerce").to_numpy(dtype=float)
+        with np.errstate(divide="ignore"):
+            exact = -(np.log10(mantissa) + exponent)
+        log10p[tiny] = np.where(np.isnan(exact), log10p[tiny], exact)
+
+    return log10p.astype(np.float32)
+
+
+def below_threshold(df, threshold):
+    # p < threshold, compared in float64 on the p-value wherever it parsed to a normal float;
+    # float32 LOG10P is only used for underflowed p-values, which are far below any threshold
+    passed = (df["LOG10P"] > -np.log10(threshold)).to_numpy()
+    for col in p_value_columns:
+        if col in df.columns:
+            p = df[col].to_numpy(dtype=float, na_value=np.nan)
+            normal = p >= np.finfo(np.float64).tiny
+            passed = np.where(normal, p < threshold, passed)
+    return passed
+
+
+def add_log10p(df):
+    # Parse p-value text into a float64 p-value plus LOG10P (unless the file already has it)
+    for col in p_value_columns:
+        if col not in df.columns:
+            continue
+        text = df[col]
+        p = pd.to_numeric(text, errors="coerce")
+        if "LOG10P" not in df.columns:
+            df.insert(df.columns.get_loc(col) + 1, "LOG10P", log10p_from_text(text, p))
+        df[col] = p.astype("float64")
+    return df
+
+
+def with_log10p(header):
+    # Column layout after read_step2: LOG10P follows the p-value column
+    header = list(header)
+    for col in p_value_columns:
+        if col in header and "LOG10P" not in header:
+            header.insert(header.index(col) + 1, "LOG10P")
+    return header
+
+
+def read_step2(path, columns=None, sep="\t", chunksize=None, **kwargs):
+    # Read a step2 (or combined) text file with compact dtypes and optional column projection
+    dtype = {**step2_dtypes, **{col: str for col in p_value_columns}}
+    if columns is not None and "LOG10P" in columns:
+        columns = list(columns) + p_value_columns
+    reader = pd.read_csv(path, sep=sep, dtype=dtype, usecols=usecols(columns), chunksize=chunksize, **kwargs)
+    if chunksize is None:
+        return add_log10p(reader)
+    return (add_log10p(chunk) for chunk in reader)
+
+
+def apply_dtypes(df):
+    # Cast columns built outside read_step2 (e.g. filename labels) to the registry dtypes
+    for col, dtype in step2_dtypes.items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def concat_frames(dfs):
+    # Concatenate keeping categoricals (pd.concat falls back to object when categories differ)
+    dfs = list(dfs)
+    for col in {col for df in dfs for col in df.columns}:
+        frames = [df for df in dfs if col in df.columns]
+        if not all(isinstance(df[col].dtype, pd.CategoricalDtype) for df in frames):
+            continue
+        categories = pd.api.types.union_categoricals([df[col] for df in frames]).categories
+        for df in frames:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from lambda_report import Log10PSketch, sketch_file
+
+
+def test_infinite_log10p_counts_in_top_bin():
+    # LOG10P is inf for p.value == "0"; those are the strongest signals, not nulls
+    sketch = Log10PSketch()
+    sketch.add([np.inf, np.inf, np.inf, 0.1, 0.1, np.nan])
+
+    assert sketch.n == 5
+    assert sketch.counts[-1] == 3
+    assert sketch.counts[0] == 0
+    assert sketch.quantile(0.5) > 29
+
+
+def test_sketch_file_with_zero_p_values(tmp_path):
+    path = tmp_path / "aou_snp_eur_step2_Height_vars_pLoF.txt"
+    pd.DataFrame({
+        "MarkerID": ["G1", "G2", "G3", "G4", "G5"],
+        "AF_Allele2": [0.1] * 5,
+        "p.value": ["0", "0", "0", "0.5", "0.9"],
+    }).to_csv(path, sep="\t", index=False)
+
+    sketch = sketch_file(str(path))
+
+    assert sketch.n == 5
+    assert sketch.counts[-1] == 3
+    assert sketch.quantile(0.5) > 29